@@ -0,0 +1,82 @@
+"""Generates a synthetic No-Intro style DAT and matching ROM files for benchmarking.
+
+Only some of the games in the DAT get actual ROM files; the rest have random checksums so
+that DATs of realistic size don't need gigabytes of ROMs to go with them.
+"""
+import argparse
+import hashlib
+import os
+import random
+import zipfile
+import zlib
+from xml.sax.saxutils import escape, quoteattr
+
+CONSOLE_NAME = 'Benchmark - Synthetic Console'
+DAT_VERSION = '20200101-000000'
+
+def generate_corpus(out_dir, games=10000, files=1000, rom_size=64 * 1024, seed=1):
+    """Writes dats/<console>.dat and roms/ into out_dir.
+
+    The first `files` games get ROM files in roms/, alternately raw and zipped under a name
+    that doesn't match the DAT. Returns (DAT path, list of ROM paths, list of SHA-1 sums of
+    all games in the DAT).
+    """
+    rnd = random.Random(seed)
+    dat_dir = os.path.join(out_dir, 'dats')
+    rom_dir = os.path.join(out_dir, 'roms')
+    os.makedirs(dat_dir, exist_ok=True)
+    os.makedirs(rom_dir, exist_ok=True)
+    datfile = os.path.join(dat_dir, CONSOLE_NAME + '.dat')
+    romfiles = []
+    sha1sums = []
+    with open(datfile, 'w', encoding='utf-8') as dat_fp:
+        dat_fp.write('<?xml version="1.0"?>\n<datafile>\n\t<header>\n')
+        dat_fp.write('\t\t<name>%s</name>\n' % CONSOLE_NAME)
+        dat_fp.write('\t\t<version>%s</version>\n\t</header>\n' % DAT_VERSION)
+        for i in range(games):
+            game = 'Synthetic Game %d (USA)' % i
+            rom_name = game + '.bin'
+            if i < files:
+                data = rnd.randbytes(rom_size)
+                size = len(data)
+                crc = zlib.crc32(data)
+                digests = [hashlib.new(kind, data).hexdigest() for kind in
+                           ('md5', 'sha1', 'sha256')]
+                if i % 2 == 0:
+                    romfile = os.path.join(rom_dir, 'rom%d.bin' % i)
+                    with open(romfile, 'wb') as rom_fp:
+                        rom_fp.write(data)
+                else:
+                    romfile = os.path.join(rom_dir, 'rom%d.zip' % i)
+                    with zipfile.ZipFile(romfile, 'w', zipfile.ZIP_DEFLATED) as zip_fp:
+                        zip_fp.writestr('rom%d.bin' % i, data)
+                romfiles.append(romfile)
+            else:
+                size = rom_size
+                crc = rnd.getrandbits(32)
+                digests = [rnd.randbytes(length).hex() for length in (16, 20, 32)]
+            sha1sums.append(digests[1].upper())
+            dat_fp.write('\t<game name=%s>\n\t\t<description>%s</description>\n' % (
+                quoteattr(game), escape(game)))
+            dat_fp.write(
+                '\t\t<rom name=%s size="%d" crc="%08x" md5="%s" sha1="%s" sha256="%s"/>\n' % (
+                    quoteattr(rom_name), size, crc, *digests))
+            dat_fp.write('\t</game>\n')
+        dat_fp.write('</datafile>\n')
+    return (datfile, romfiles, sha1sums)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('out_dir')
+    parser.add_argument('--games', type=int, default=10000, help='Games in the DAT')
+    parser.add_argument('--files', type=int, default=1000, help='Games with ROM files')
+    parser.add_argument('--rom-size', type=int, default=64 * 1024, help='Bytes per ROM')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    (datfile, romfiles, _) = generate_corpus(
+        args.out_dir, args.games, min(args.files, args.games), args.rom_size, args.seed)
+    print('DAT:', datfile)
+    print('ROM files:', len(romfiles))
+
+if __name__ == '__main__':
+    main()
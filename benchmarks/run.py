@@ -0,0 +1,166 @@
+"""Times the stages of the verify pipeline on a synthetic corpus and writes the results as JSON.
+
+Run from the repository root, e.g.:
+    python -m benchmarks.run --games 100000 --files 2000 -o results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from romverify.datfiles import DatReader, get_index_file
+from romverify.filehandler import FileHandler
+from romverify.report import TextReport
+from romverify.romsorter import RomSorter
+from .corpus import generate_corpus
+
+BUFFER_SIZES = (16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024)
+
+def best_time(func, repeat):
+    """Returns the fastest of `repeat` calls to func, in seconds."""
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+def bench_readfiles(dat_dir, repeat):
+    index_file = get_index_file(dat_dir)
+    def cold():
+        if os.path.exists(index_file):
+            os.remove(index_file)
+        DatReader().readfiles(dat_dir)
+    return {
+        'cold_index_seconds': best_time(cold, repeat),
+        'warm_index_seconds': best_time(lambda: DatReader().readfiles(dat_dir), repeat),
+        'header_only_seconds': best_time(
+            lambda: DatReader().readfiles(dat_dir, header_only=True), repeat),
+    }
+
+def bench_get_rominfo(dat_dir, sha1sums, lookups, repeat):
+    reader = DatReader()
+    reader.readfiles(dat_dir)
+    rnd = random.Random(2)
+    # Half of the lookups are for ROMs that aren't in the DAT
+    hits = [rnd.choice(sha1sums) for _ in range(lookups // 2)]
+    misses = ['%040X' % rnd.getrandbits(160) for _ in range(lookups - len(hits))]
+    def lookup(sha1sums):
+        for sha1sum in sha1sums:
+            reader.get_rominfo(sha1sum=sha1sum)
+    hit_seconds = best_time(lambda: lookup(hits), repeat)
+    miss_seconds = best_time(lambda: lookup(misses), repeat)
+    return {
+        'lookups': lookups,
+        'hit_microseconds': hit_seconds / max(len(hits), 1) * 1e6,
+        'miss_microseconds': miss_seconds / max(len(misses), 1) * 1e6,
+    }
+
+def bench_hashing(work_dir, size_mib, repeat):
+    filename = os.path.join(work_dir, 'hash.bin')
+    with open(filename, 'wb') as out_fp:
+        for _ in range(size_mib):
+            out_fp.write(os.urandom(1024 * 1024))
+    romfile = FileHandler(filename)
+    # Warm up the page cache so every buffer size reads from memory alike
+    romfile.get_sha1sum()
+    results = {'file_mib': size_mib}
+    results['get_sha1sum_mib_per_second'] = \
+        size_mib / best_time(romfile.get_sha1sum, repeat)
+    for buffer_size in BUFFER_SIZES:
+        seconds = best_time(lambda: romfile.get_digests(('sha1',), buffer_size), repeat)
+        results['sha1_buffer_%dk_mib_per_second' % (buffer_size // 1024)] = size_mib / seconds
+    os.remove(filename)
+    return results
+
+def bench_organize(dat_dir, rom_dir, work_dir, jobs, compress_types):
+    reader = DatReader()
+    reader.readfiles(dat_dir)
+    results = {}
+    for compress_type in compress_types:
+        # Each run renames files in place, so it gets a fresh copy of the ROMs
+        run_dir = os.path.join(work_dir, 'organize')
+        shutil.rmtree(run_dir, ignore_errors=True)
+        shutil.copytree(rom_dir, run_dir)
+        filenames = [os.path.join(run_dir, name) for name in sorted(os.listdir(run_dir))]
+        with open(os.devnull, 'w') as devnull:
+            report = TextReport(devnull)
+            sorter = RomSorter(
+                reader, compress_type=compress_type, jobs=jobs, report=report)
+            start_time = time.perf_counter()
+            sorter.organize_files(filenames, using_config=False)
+            seconds = time.perf_counter() - start_time
+        results[compress_type or 'none'] = {
+            'files': len(filenames),
+            'seconds': seconds,
+            'files_per_second': len(filenames) / seconds,
+            'counts': report.counts,
+        }
+        shutil.rmtree(run_dir)
+    return results
+
+def get_git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--games', type=int, default=10000, help='Games in the DAT')
+    parser.add_argument('--files', type=int, default=1000, help='Games with ROM files')
+    parser.add_argument('--rom-size', type=int, default=64 * 1024, help='Bytes per ROM')
+    parser.add_argument('--lookups', type=int, default=10000, help='get_rominfo calls')
+    parser.add_argument('--hash-size', type=int, default=64, help='MiB of data to hash')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Jobs for organize')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each timing')
+    parser.add_argument('--work-dir', help='Where to generate the corpus (default: temp dir)')
+    parser.add_argument('-o', '--output', help='JSON output file (default: stdout)')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='romverify-bench-')
+    try:
+        print('Generating corpus in', work_dir, file=sys.stderr)
+        (datfile, _, sha1sums) = generate_corpus(
+            work_dir, args.games, min(args.files, args.games), args.rom_size)
+        dat_dir = os.path.dirname(datfile)
+        rom_dir = os.path.join(work_dir, 'roms')
+        results = {
+            'meta': {
+                'revision': get_git_revision(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'options': vars(args),
+            },
+        }
+        print('Timing DatReader.readfiles', file=sys.stderr)
+        results['readfiles'] = bench_readfiles(dat_dir, args.repeat)
+        print('Timing get_rominfo', file=sys.stderr)
+        results['get_rominfo'] = bench_get_rominfo(
+            dat_dir, sha1sums, args.lookups, args.repeat)
+        print('Timing hashing', file=sys.stderr)
+        results['hashing'] = bench_hashing(work_dir, args.hash_size, args.repeat)
+        print('Timing organize_files', file=sys.stderr)
+        results['organize'] = bench_organize(
+            dat_dir, rom_dir, work_dir, args.jobs, ('zip', None))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    output = json.dumps(results, indent=2) + '\n'
+    if args.output:
+        with open(args.output, 'w') as out_fp:
+            out_fp.write(output)
+    else:
+        sys.stdout.write(output)
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,17 @@
 __all__ = [
     'main',
+    'collection',
+    'compression',
     'config',
     'datfiles',
+    'datindex',
+    'dedupe',
     'filehandler',
-    'romsorter'
+    'hashcache',
+    'journal',
+    'profiling',
+    'report',
+    'romsorter',
+    'scanner',
+    'watcher'
 ]
@@ -0,0 +1,104 @@
+import os
+from .datindex import get_store_file, open_store
+from .scanner import FileScanner
+
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+DROP TABLE IF EXISTS files;
+CREATE TABLE files (
+    collection TEXT NOT NULL,
+    path TEXT NOT NULL,
+    member TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha1 TEXT,
+    PRIMARY KEY (collection, path, member)
+);
+'''
+
+def get_manifest_file():
+    return get_store_file('rom_collections.sqlite')
+
+class CollectionManifest:
+    """Stored listing of the files in each collection directory and their SHA-1 checksums.
+
+    Archives holding several ROMs have an entry for each member. Other files have one entry
+    with an empty member name.
+    """
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = get_manifest_file()
+        self.filename = filename
+        self.db = open_store(filename, SCHEMA, SCHEMA_VERSION)
+
+    def close(self):
+        self.db.close()
+
+    def refresh(self, collection_dir, sorter):
+        """Brings the listing of a collection directory up to date.
+
+        Only files that are new or whose size or mtime changed are hashed, using `sorter`.
+        Returns {(path relative to collection_dir, member): hex SHA-1 or None if unhashed}.
+        """
+        listing = {}
+        stored = {}
+        for (path, member, size, mtime_ns, sha1) in self.db.execute(
+                'SELECT path, member, size, mtime_ns, sha1 FROM files WHERE collection = ?',
+                (collection_dir,)):
+            stored[path] = (size, mtime_ns)
+            listing[(path, member)] = sha1
+        changed = {}
+        for (path, stat_result) in FileScanner(recursive=True).scan([collection_dir]):
+            relpath = os.path.relpath(path, collection_dir)
+            if stored.pop(relpath, None) != (stat_result.st_size, stat_result.st_mtime_ns):
+                changed[path] = stat_result
+        for relpath in stored:
+            self.remove_path(collection_dir, relpath, listing)
+        for result in sorter.hash_files(changed):
+            relpath = os.path.relpath(result.filename, collection_dir)
+            stat_result = changed[result.filename]
+            self.remove_path(collection_dir, relpath, listing)
+            entries = [(member.filename, member.sha1sum) for member in result.members]
+            if not entries:
+                entries = [('', result.sha1sum)]
+            for (member, sha1) in entries:
+                listing[(relpath, member)] = sha1
+                self.db.execute(
+                    'INSERT INTO files (collection, path, member, size, mtime_ns, sha1) ' +
+                    'VALUES (?,?,?,?,?,?)', (collection_dir, relpath, member,
+                                             stat_result.st_size, stat_result.st_mtime_ns, sha1))
+        self.db.commit()
+        return listing
+
+    def remove_path(self, collection_dir, relpath, listing):
+        for key in [key for key in listing if key[0] == relpath]:
+            del listing[key]
+        self.db.execute(
+            'DELETE FROM files WHERE collection = ? AND path = ?', (collection_dir, relpath))
+
+def find_missing(console_roms, listing):
+    """Finds the games of a console that aren't complete in a collection listing.
+
+    `console_roms` is a list of (sha1, game name, rom name), as from
+    DatReader.get_console_roms. Returns a sorted list of (game name, ROMs present, ROMs in
+    the game).
+    """
+    present = set(listing.values())
+    totals = {}
+    found = {}
+    for (sha1, game, rom_name) in set(console_roms):
+        totals[game] = totals.get(game, 0) + 1
+        if sha1 in present:
+            found[game] = found.get(game, 0) + 1
+    return sorted((game, found.get(game, 0), total) for (game, total) in totals.items()
+                  if found.get(game, 0) < total)
+
+def find_strays(console_roms, listing):
+    """Returns the relative paths of files in a collection listing that aren't in the DAT.
+
+    An archive is only a stray if none of its members are in the DAT.
+    """
+    known = {sha1 for (sha1, _, _) in console_roms}
+    matched = {path for ((path, _), sha1) in listing.items() if sha1 in known}
+    return sorted({path for (path, _) in listing} - matched)
@@ -0,0 +1,29 @@
+# Kept apart from filehandler so the command line can be set up without importing zipfile
+# and the other archive modules.
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Supported output formats and the extension each adds. 'store' is a zip without compression,
+# for ROMs that are already compressed or encrypted.
+COMPRESS_TYPES = {
+    'zip': '.zip',
+    'store': '.zip',
+    'gz': '.gz',
+    'xz': '.xz',
+    'bz2': '.bz2',
+}
+if zstandard is not None:
+    COMPRESS_TYPES['zstd'] = '.zst'
+
+# Range of --level accepted by each output format
+COMPRESS_LEVELS = {
+    'zip': (0, 9),
+    'store': (0, 9),
+    'gz': (0, 9),
+    'xz': (0, 9),
+    'bz2': (1, 9),
+    'zstd': (1, 22),
+}
@@ -1,97 +1,369 @@
+import concurrent.futures
+import itertools
 import os
+import shutil
+import sys
 import xml.etree.ElementTree as ET
-from .filehandler import FileHandler
+import zipfile
+from . import profiling
+from .datindex import DatIndex, INDEXED_DIGESTS, get_data_dir, get_index_file
+from .filehandler import DEFAULT_BUFFER_SIZE, FileHandler, atomic_output
 
-def get_data_dir():
-    home_dir = os.environ.get('HOME')
-    data_dir = os.environ.get('XDG_DATA_HOME', os.path.join(home_dir, '.local/share'))
-    data_dir = os.path.join(data_dir, 'eberjand/rom_dats')
-    return data_dir
+# Preferred digests for identifying a ROM, strongest first
+LOOKUP_ORDER = ('sha1', 'sha256', 'md5')
 
 def clean_file_name(name):
     # TODO deal with Windows filename restrictions too
     return name.replace('/', '_')
 
+def load_dat(datfile, verify_filename=False, header_only=False):
+    """Parses the header of a DAT file, without reading any further into it.
+
+    Returns (console name, version, roms) or a tuple of None if the DAT is invalid.
+    Unless header_only is given, roms is a generator that streams the rest of the file as
+    described in iter_dat_roms.
+    """
+    fp_in = None
+    try:
+        fp_in = FileHandler(datfile).open()
+        (console_name, version, events, root) = read_dat_header(fp_in)
+    except:
+        # A parse error occurred such as xml.etree.ElementTree.ParseError
+        if fp_in is not None:
+            fp_in.close()
+        return (None, None, None)
+    if verify_filename:
+        basename = os.path.basename(datfile)
+        if clean_file_name(console_name) + '.dat' != basename:
+            print('WARNING: Stray file ignored:', basename, file=sys.stderr)
+            header_only = True
+            console_name = version = None
+    if header_only:
+        fp_in.close()
+        return (console_name, version, None)
+    return (console_name, version, iter_dat_roms(fp_in, events, root))
+
+def read_dat_header(fp_in):
+    """Parses a DAT from an open file up to the end of its header.
+
+    Returns (console name, version, iterparse events, root element) so the caller can go on
+    reading ROMs. Raises an exception if the DAT is invalid.
+    """
+    events = ET.iterparse(fp_in, events=('start', 'end'))
+    (_, root) = next(events)
+    for (event, elem) in events:
+        if event == 'end' and elem.tag == 'header':
+            header = elem
+            break
+    return (header.find('name').text, header.find('version').text, events, root)
+
+def parse_int(value, base=10):
+    try:
+        return int(value, base)
+    except (TypeError, ValueError):
+        return None
+
+def iter_dat_roms(fp_in, events, root):
+    """Yields (game name, rom name, size, crc32, hex digests) for each ROM in a DAT being parsed.
+
+    Games made of several files, like disc images with many tracks, yield one entry per ROM.
+    The size and CRC32 are ints or None if missing from the DAT. The hex digests are a
+    dict with whichever of INDEXED_DIGESTS the DAT provides.
+    Each game is discarded once read, so memory use doesn't grow with the size of the DAT.
+    Raises xml.etree.ElementTree.ParseError if the rest of the DAT is malformed.
+    """
+    with fp_in:
+        for (event, elem) in events:
+            if event != 'end' or elem.tag != 'game':
+                continue
+            for rom in elem.iterfind('rom'):
+                romfile = rom.attrib.get('name')
+                if romfile is None:
+                    continue
+                game = elem.attrib.get('name', os.path.splitext(romfile)[0])
+                size = parse_int(rom.attrib.get('size'))
+                crc = parse_int(rom.attrib.get('crc'), 16)
+                hexdigests = {}
+                for kind in INDEXED_DIGESTS:
+                    value = rom.attrib.get(kind)
+                    if value is not None:
+                        hexdigests[kind] = value.upper()
+                yield (game, romfile, size, crc, hexdigests)
+            root.clear()
+
 class DatReader:
     def __init__(self):
         self.clear()
 
-    def get_rominfo(self, sha1sum):
-        return self.games_by_sha1.get(sha1sum)
+    def get_rominfo(self, sha1sum=None, digests=None):
+        """Looks up a ROM by its SHA-1 or by any of `digests`, a dict of {kind: hex digest}.
+
+        Returns (console, rom name, game name) or None if there's no match.
+        """
+        if digests is None:
+            digests = {'sha1': sha1sum}
+        for kind in LOOKUP_ORDER:
+            hexdigest = digests.get(kind)
+            if hexdigest is None:
+                continue
+            if self.index is not None:
+                rom_desc = self.index.lookup_digest(kind, hexdigest)
+            else:
+                rom_descs = self.games_by_digest[kind].get(hexdigest.upper())
+                rom_desc = rom_descs[0] if rom_descs else None
+            if rom_desc is not None:
+                return rom_desc
+        return None
+
+    def get_all_rominfo(self, sha1sum=None, digests=None):
+        """Like get_rominfo, but returns a list of every match, best first.
+
+        More than one match means the same ROM is in several games or consoles.
+        """
+        if digests is None:
+            digests = {'sha1': sha1sum}
+        for kind in LOOKUP_ORDER:
+            hexdigest = digests.get(kind)
+            if hexdigest is None:
+                continue
+            if self.index is not None:
+                rom_descs = self.index.lookup_digest_all(kind, hexdigest)
+            else:
+                rom_descs = self.games_by_digest[kind].get(hexdigest.upper(), [])
+            if rom_descs:
+                return list(rom_descs)
+        return []
+
+    def get_digest_kinds(self):
+        """Returns the set of digest kinds provided by the loaded DATs."""
+        if self.index is not None:
+            return self.index.get_digest_kinds()
+        return {kind for (kind, games) in self.games_by_digest.items() if games}
+
+    def get_console_roms(self, console):
+        """Returns a list of (hex SHA-1, game name, rom name) for every ROM of a console.
+
+        ROMs with the same checksum, like identical tracks of different discs, each have a row.
+        """
+        if self.index is not None:
+            return self.index.get_console_roms(console)
+        return [(sha1, rom_desc[2], rom_desc[1])
+                for (sha1, rom_descs) in self.games_by_sha1.items()
+                for rom_desc in rom_descs if rom_desc[0] == console]
+
+    def get_game_roms(self, console, game):
+        """Returns {rom name: hex SHA-1 or None} for every ROM in a game."""
+        if self.index is not None:
+            return self.index.get_game_roms(console, game)
+        return self.games.get((console, game), {})
+
+    def get_rominfo_by_crc(self, size, crc):
+        """Finds a candidate match by size and CRC32, which are known without decompressing."""
+        if self.index is not None:
+            return self.index.lookup_crc(size, crc)
+        return self.games_by_crc.get((size, crc))
 
     def clear(self):
         self.consoles = {}
-        self.games_by_sha1 = {}
+        self.games_by_digest = {kind: {} for kind in INDEXED_DIGESTS}
+        self.games_by_sha1 = self.games_by_digest['sha1']
+        self.games_by_crc = {}
+        self.games = {}
+        self.index = None
 
     def readfiles(self, data_dir=None, header_only=False):
         if data_dir is None:
             data_dir = get_data_dir()
-        for datfile in os.listdir(data_dir):
-            self.readfile(os.path.join(data_dir, datfile), header_only, True)
+        if not header_only:
+            # Checksums are looked up lazily from the compiled index instead of being loaded
+            self.index = update_index(data_dir)
+            self.consoles.update(self.index.get_consoles())
+            return
+        # Headers come from the index's catalog of DATs rather than the DATs themselves
+        index = DatIndex(get_index_file(data_dir))
+        try:
+            for (console_name, version) in index.get_headers(data_dir).values():
+                if console_name is not None:
+                    self.consoles[console_name] = version
+        finally:
+            index.close()
 
     def readfile(self, datfile, header_only=False, verify_filename=False):
-        try:
-            tree = ET.parse(FileHandler(datfile).open())
-        except:
-            # A parse error occurred such as xml.etree.ElementTree.ParseError
-            return (None, None)
-        root = tree.getroot()
-        header = root.find('header')
-        console_name = header.find('name').text
-        version = header.find('version').text
-        if verify_filename:
-            basename = os.path.basename(datfile)
-            if clean_file_name(console_name) + '.dat' != basename:
-                print('WARNING: Stray file ignored:', basename)
+        with profiling.stage('dat header' if header_only else 'dat parse') as timer:
+            (console_name, version, roms) = load_dat(datfile, verify_filename, header_only)
+            if console_name is None:
                 return (None, None)
-        self.consoles[console_name] = version
 
-        if not header_only:
-            self.readfile_checksums(root, console_name)
+            if not header_only:
+                if profiling.enabled:
+                    timer.add_bytes(os.path.getsize(datfile))
+                try:
+                    self.readfile_checksums(roms, console_name)
+                except ET.ParseError:
+                    return (None, None)
+        self.consoles[console_name] = version
         return (console_name, version)
 
-    def readfile_checksums(self, xml_root, console_name):
-        for game_entry in xml_root.findall('game'):
-            rom = game_entry.find('rom')
-            romfile = rom.attrib.get('name')
-            sha1 = rom.attrib.get('sha1')
-            if romfile is None or sha1 is None:
+    def readfile_checksums(self, roms, console_name):
+        for (game, romfile, size, crc, hexdigests) in roms:
+            rom_desc = (console_name, romfile, game)
+            self.games.setdefault((console_name, game), {})[romfile] = hexdigests.get('sha1')
+            if size is not None and crc is not None:
+                self.games_by_crc[(size, crc)] = rom_desc
+            for (kind, hexdigest) in hexdigests.items():
+                self.games_by_digest[kind].setdefault(hexdigest, []).append(rom_desc)
+
+def warn_shared_roms(index, basename, console_name):
+    """Warns about the ROMs of a newly indexed DAT that another console's DATs also list."""
+    shared = {}
+    for (other_console, romfile) in index.get_shared_roms(basename):
+        shared.setdefault(other_console, []).append(romfile)
+    for (other_console, romfiles) in shared.items():
+        print('WARNING: Duplicate checksum in both "%s" and "%s"' %
+              (other_console, console_name), file=sys.stderr)
+        print('         For ROM: %s' % romfiles[0], file=sys.stderr)
+        if len(romfiles) > 1:
+            print('         And %d more' % (len(romfiles) - 1), file=sys.stderr)
+
+def index_dat_file(index, datfile):
+    """Adds or replaces a single installed DAT file in the checksum index."""
+    basename = os.path.basename(datfile)
+    stat_result = os.stat(datfile)
+    (console_name, version, roms) = load_dat(datfile, verify_filename=True)
+    try:
+        with profiling.stage('dat index', stat_result.st_size):
+            if console_name is None:
+                index.remove_dat(basename)
+            else:
+                index.replace_dat(basename, console_name, version, stat_result, roms)
+            index.commit()
+        if console_name is not None:
+            warn_shared_roms(index, basename, console_name)
+    except ET.ParseError:
+        index.rollback()
+        index.remove_dat(basename)
+        index.commit()
+
+def update_index(data_dir=None):
+    """Opens the checksum index, re-indexing any DAT files in data_dir that changed since."""
+    if data_dir is None:
+        data_dir = get_data_dir()
+    index = DatIndex(get_index_file(data_dir))
+    stale = index.get_dats()
+    for datfile in os.listdir(data_dir):
+        datpath = os.path.join(data_dir, datfile)
+        indexed = stale.pop(datfile, None)
+        if indexed is not None:
+            stat_result = os.stat(datpath)
+            if indexed[2:] == (stat_result.st_mtime_ns, stat_result.st_size):
                 continue
-            #if sha1 in self.games_by_sha1:
-            #    print('WARNING: Duplicate checksum in both "%s" and "%s"' %
-            #        (self.games_by_sha1[sha1][0], console_name))
-            #    print('         For ROM: %s' % romfile)
-            self.games_by_sha1[sha1] = (console_name, romfile)
+        index_dat_file(index, datpath)
+    for datfile in stale:
+        index.remove_dat(datfile)
+    index.commit()
+    return index
+
+def check_dat_version(store_filename, version, installed, force=False):
+    """Compares a DAT to the installed one for the same console, printing the outcome.
+
+    Returns the message to print once it's installed, or None if it should be skipped.
+    """
+    if store_filename not in installed:
+        return 'Installed successfully'
+    oldversion = installed[store_filename]
+    print('  Current:', oldversion)
+    if oldversion is None:
+        return 'Replaced invalid dat file'
+    if version > oldversion:
+        return 'Installed updated dat file'
+    elif force:
+        return 'Overwrote previous dat file'
+    elif version == oldversion:
+        print('  Skipping because installed dat file is already up to date')
+        print('  Use --force to replace it')
+    else:
+        print('  Skipping because installed dat file is newer')
+        print('  Use --force to force a downgrade')
+    return None
+
+def install_dat_files(datfiles, force=False):
+    """Installs DAT files, or No-Intro daily packs of them, and indexes the ones that changed."""
+    data_dir = get_data_dir()
+    os.makedirs(data_dir, exist_ok=True)
+    index = DatIndex(get_index_file(data_dir))
+    try:
+        installed = {filename: version for (filename, (_, version)) in
+                     index.get_headers(data_dir).items()}
+        for datfile in datfiles:
+            if FileHandler(datfile).get_member_count() > 1:
+                install_dat_pack(index, data_dir, installed, datfile, force)
+            else:
+                install_dat_file(index, data_dir, installed, datfile, force)
+    finally:
+        index.close()
 
-def install_dat_file(datfile, force=False):
+def install_dat_file(index, data_dir, installed, datfile, force=False):
     print('Processing:', datfile)
-    (console_name, version) = DatReader().readfile(datfile, header_only=True)
+    (console_name, version, _) = load_dat(datfile, header_only=True)
     if console_name is None:
         print('  Invalid DAT file')
         return
     print('  Console:', console_name)
     print('  Version:', version)
     store_filename = clean_file_name(console_name) + '.dat'
-    data_dir = get_data_dir()
-    os.makedirs(data_dir, exist_ok=True)
     store_filepath = os.path.join(data_dir, store_filename)
-    success_message = None
-    if os.path.exists(store_filepath):
-        oldheader = DatReader().readfile(store_filepath, header_only=True)
-        oldversion = oldheader[1]
-        print('  Current:', oldversion)
-        if version > oldversion:
-            success_message = 'Installed updated dat file'
-        elif force:
-            success_message = 'Overwrote previous dat file'
-        elif version == oldversion:
-            print('  Skipping because installed dat file is already up to date')
-            print('  Use --force to replace it')
-        else:
-            print('  Skipping because installed dat file is newer')
-            print('  Use --force to force a downgrade')
-    else:
-        success_message = 'Installed successfully'
+    success_message = check_dat_version(store_filename, version, installed, force)
     if success_message is not None:
         FileHandler(datfile).move(store_filepath, None)
+        index_dat_file(index, store_filepath)
+        installed[store_filename] = version
         print('  ' + success_message)
+
+def read_pack_header(packfile, member_info):
+    """Returns (console name, version) of a DAT in a zip, or a tuple of None if invalid.
+
+    This runs in a worker thread, so it opens the zip on its own.
+    """
+    try:
+        with zipfile.ZipFile(packfile) as zip_fp:
+            with zip_fp.open(member_info) as fp_in:
+                return read_dat_header(fp_in)[:2]
+    except:
+        return (None, None)
+
+def install_dat_pack(index, data_dir, installed, packfile, force=False):
+    """Installs the changed DATs from a zip of many, like the No-Intro daily pack.
+
+    Headers are compared in parallel straight from the zip, then only the DATs of consoles
+    that changed are extracted and re-indexed.
+    """
+    print('Processing:', packfile)
+    with zipfile.ZipFile(packfile) as zip_fp:
+        members = [info for info in zip_fp.infolist()
+                   if info.filename.lower().endswith('.dat') and not info.is_dir()]
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        headers = list(executor.map(read_pack_header, itertools.repeat(packfile), members))
+    up_to_date = 0
+    with zipfile.ZipFile(packfile) as zip_fp:
+        for (member_info, (console_name, version)) in zip(members, headers):
+            if console_name is None:
+                print('  Invalid DAT file:', member_info.filename)
+                continue
+            store_filename = clean_file_name(console_name) + '.dat'
+            if installed.get(store_filename) == version and not force:
+                up_to_date += 1
+                continue
+            print('Processing:', member_info.filename)
+            print('  Console:', console_name)
+            print('  Version:', version)
+            success_message = check_dat_version(store_filename, version, installed, force)
+            if success_message is None:
+                continue
+            store_filepath = os.path.join(data_dir, store_filename)
+            with atomic_output(store_filepath) as temp_filepath:
+                with zip_fp.open(member_info) as in_fp, open(temp_filepath, 'wb') as out_fp:
+                    shutil.copyfileobj(in_fp, out_fp, DEFAULT_BUFFER_SIZE)
+            index_dat_file(index, store_filepath)
+            installed[store_filename] = version
+            print('  ' + success_message)
+    print('Already up to date: %d of %d dat files' % (up_to_date, len(members)))
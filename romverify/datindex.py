@@ -0,0 +1,211 @@
+import os
+import sqlite3
+
+# Hex digests stored as raw bytes; the names double as column names
+INDEXED_DIGESTS = ('md5', 'sha1', 'sha256')
+
+# Bump whenever the table layout changes; an outdated index is simply rebuilt from the DATs
+SCHEMA_VERSION = 4
+
+SCHEMA = '''
+DROP TABLE IF EXISTS roms;
+DROP TABLE IF EXISTS dats;
+CREATE TABLE dats (
+    id INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL UNIQUE,
+    console TEXT NOT NULL,
+    version TEXT,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    digests TEXT NOT NULL
+);
+CREATE TABLE roms (
+    dat_id INTEGER NOT NULL,
+    game TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER,
+    crc INTEGER,
+    md5 BLOB,
+    sha1 BLOB,
+    sha256 BLOB
+);
+CREATE INDEX roms_md5 ON roms (md5);
+CREATE INDEX roms_sha1 ON roms (sha1);
+CREATE INDEX roms_sha256 ON roms (sha256);
+CREATE INDEX roms_size_crc ON roms (size, crc);
+CREATE INDEX roms_dat_game ON roms (dat_id, game);
+'''
+
+def get_data_dir():
+    home_dir = os.environ.get('HOME')
+    data_dir = os.environ.get('XDG_DATA_HOME', os.path.join(home_dir, '.local/share'))
+    data_dir = os.path.join(data_dir, 'eberjand/rom_dats')
+    return data_dir
+
+def get_store_file(name):
+    """Returns the path of a sqlite store kept next to the DAT directory."""
+    return os.path.join(os.path.dirname(get_data_dir()), name)
+
+def open_store(filename, schema, schema_version):
+    """Connects to a sqlite store, (re)creating its tables unless they're at schema_version."""
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    db = sqlite3.connect(filename)
+    if db.execute('PRAGMA user_version').fetchone()[0] != schema_version:
+        db.executescript(schema)
+        db.execute('PRAGMA user_version = %d' % schema_version)
+        db.commit()
+    return db
+
+def get_index_file(data_dir=None):
+    if data_dir is None:
+        data_dir = get_data_dir()
+    return os.path.normpath(data_dir) + '.sqlite'
+
+class DatIndex:
+    """Compiled on-disk index of the ROMs in installed DAT files.
+
+    Checksums are stored as raw digests so lookups never need the DAT XML to be parsed.
+    Each DAT is tracked by its mtime and size so that only changed files get re-indexed.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = open_store(filename, SCHEMA, SCHEMA_VERSION)
+
+    def close(self):
+        self.db.close()
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def get_dats(self):
+        """Returns {filename: (console, version, mtime_ns, size)} for every indexed DAT."""
+        cursor = self.db.execute('SELECT filename, console, version, mtime_ns, size FROM dats')
+        return {row[0]: row[1:] for row in cursor}
+
+    def get_headers(self, data_dir):
+        """Returns {filename: (console, version)} for every DAT file in data_dir.
+
+        This is a catalog of the installed DATs that doesn't touch their XML, except to read
+        the headers of files that were added or changed since they were last indexed. Those
+        have (None, None) if they're invalid.
+        """
+        indexed = self.get_dats()
+        headers = {}
+        try:
+            entries = list(os.scandir(data_dir))
+        except FileNotFoundError:
+            return headers
+        for entry in entries:
+            info = indexed.get(entry.name)
+            stat_result = entry.stat()
+            if info is not None and info[2:] == (stat_result.st_mtime_ns, stat_result.st_size):
+                headers[entry.name] = info[:2]
+            else:
+                # Imported here so that reading the catalog doesn't need the XML parser
+                from .datfiles import load_dat
+                headers[entry.name] = load_dat(
+                    entry.path, verify_filename=True, header_only=True)[:2]
+        return headers
+
+    def get_consoles(self):
+        return dict(self.db.execute('SELECT console, version FROM dats'))
+
+    def replace_dat(self, filename, console, version, stat_result, roms):
+        """Replaces all indexed entries of a DAT file with `roms` from iter_dat_roms."""
+        self.remove_dat(filename)
+        cursor = self.db.execute(
+            'INSERT INTO dats (filename, console, version, mtime_ns, size, digests) ' +
+            'VALUES (?,?,?,?,?,?)',
+            (filename, console, version, stat_result.st_mtime_ns, stat_result.st_size, ''))
+        dat_id = cursor.lastrowid
+        present = set()
+        def rows():
+            for (game, romfile, size, crc, hexdigests) in roms:
+                row = [dat_id, game, romfile, size, crc]
+                for kind in INDEXED_DIGESTS:
+                    try:
+                        row.append(bytes.fromhex(hexdigests[kind]))
+                        present.add(kind)
+                    except (KeyError, ValueError):
+                        row.append(None)
+                yield row
+        self.db.executemany(
+            'INSERT INTO roms (dat_id, game, name, size, crc, md5, sha1, sha256) ' +
+            'VALUES (?,?,?,?,?,?,?,?)', rows())
+        self.db.execute(
+            'UPDATE dats SET digests = ? WHERE id = ?', (','.join(sorted(present)), dat_id))
+
+    def get_shared_roms(self, filename):
+        """Returns (other console, rom name) for each ROM of a DAT file whose SHA-1 is also
+        listed under another console.
+        """
+        return self.db.execute(
+            'SELECT DISTINCT others.console, roms.name FROM dats ' +
+            'JOIN roms ON roms.dat_id = dats.id ' +
+            'JOIN roms AS shared ON shared.sha1 = roms.sha1 ' +
+            'JOIN dats AS others ON others.id = shared.dat_id ' +
+            'WHERE dats.filename = ? AND others.console != dats.console ' +
+            'ORDER BY roms.rowid', (filename,)).fetchall()
+
+    def remove_dat(self, filename):
+        self.db.execute(
+            'DELETE FROM roms WHERE dat_id IN (SELECT id FROM dats WHERE filename = ?)',
+            (filename,))
+        self.db.execute('DELETE FROM dats WHERE filename = ?', (filename,))
+
+    def get_digest_kinds(self):
+        """Returns the set of digest kinds that at least one indexed DAT provides."""
+        kinds = set()
+        for (digests,) in self.db.execute('SELECT DISTINCT digests FROM dats'):
+            kinds.update(filter(None, digests.split(',')))
+        return kinds
+
+    def lookup_digest(self, kind, hexdigest):
+        """Returns (console, rom name, game name) for a hex digest of one of INDEXED_DIGESTS.
+
+        Returns None if the digest is unknown.
+        """
+        matches = self.lookup_digest_all(kind, hexdigest, limit=1)
+        return matches[0] if matches else None
+
+    def lookup_digest_all(self, kind, hexdigest, limit=-1):
+        """Returns a list of every (console, rom name, game name) with the given digest.
+
+        The same ROM can be listed several times, like in more than one console's DAT.
+        """
+        if kind not in INDEXED_DIGESTS:
+            raise ValueError('Unsupported digest: ' + kind)
+        try:
+            digest = bytes.fromhex(hexdigest)
+        except ValueError:
+            return []
+        return self.db.execute(
+            'SELECT dats.console, roms.name, roms.game FROM roms ' +
+            'JOIN dats ON dats.id = roms.dat_id ' +
+            'WHERE roms.%s = ? ORDER BY roms.rowid LIMIT ?' % kind, (digest, limit)).fetchall()
+
+    def lookup_crc(self, size, crc):
+        """Returns (console, rom name, game name) for a ROM's size and CRC32, or None."""
+        return self.db.execute(
+            'SELECT dats.console, roms.name, roms.game FROM roms ' +
+            'JOIN dats ON dats.id = roms.dat_id ' +
+            'WHERE roms.size = ? AND roms.crc = ? LIMIT 1', (size, crc)).fetchone()
+
+    def get_console_roms(self, console):
+        """Returns a list of (hex SHA-1, game name, rom name) for every ROM of a console."""
+        cursor = self.db.execute(
+            'SELECT roms.sha1, roms.game, roms.name FROM roms ' +
+            'JOIN dats ON dats.id = roms.dat_id ' +
+            'WHERE dats.console = ? AND roms.sha1 IS NOT NULL', (console,))
+        return [(sha1.hex().upper(), game, name) for (sha1, game, name) in cursor]
+
+    def get_game_roms(self, console, game):
+        """Returns {rom name: hex SHA-1 or None} for every ROM in a game."""
+        cursor = self.db.execute(
+            'SELECT roms.name, roms.sha1 FROM roms JOIN dats ON dats.id = roms.dat_id ' +
+            'WHERE dats.console = ? AND roms.game = ?', (console, game))
+        return {name: sha1.hex().upper() if sha1 is not None else None
+                for (name, sha1) in cursor}
@@ -0,0 +1,68 @@
+import concurrent.futures
+import os
+import stat
+from .filehandler import DEFAULT_BUFFER_SIZE, FileHandler, hash_stream
+from .hashcache import get_cache_key
+
+def hash_file(filename):
+    """Returns the SHA-1 of a file's own bytes, without decompressing it. Runs in a thread."""
+    with open(filename, 'rb', buffering=0) as fp_in:
+        return hash_stream(fp_in, ('sha1',), bytearray(DEFAULT_BUFFER_SIZE))['sha1']
+
+def find_duplicates(scanned, hash_cache=None, jobs=1):
+    """Finds sets of identical files among (path, stat result) pairs from a FileScanner.
+
+    Files are first grouped by size, so only files sharing their size with another one are
+    hashed at all. Paths that are already hard links to the same file count as one.
+    Returns a list of duplicate sets, each a list of paths in the order they were scanned.
+    """
+    # {size: {(device, inode): [path, ...]}}
+    by_size = {}
+    stat_results = {}
+    for (path, stat_result) in scanned:
+        if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
+            continue
+        if stat_result.st_size == 0:
+            continue
+        inodes = by_size.setdefault(stat_result.st_size, {})
+        inodes.setdefault((stat_result.st_dev, stat_result.st_ino), []).append(path)
+        stat_results[path] = stat_result
+
+    candidates = [paths[0] for inodes in by_size.values() if len(inodes) > 1
+                  for paths in inodes.values()]
+    sha1sums = {}
+    to_hash = []
+    for path in candidates:
+        cache_key = None
+        # The cache holds decompressed checksums for gz/xz/bz2/7z/zstd files, not their own bytes
+        if hash_cache is not None and FileHandler(path).stream_type is None:
+            cache_key = get_cache_key(stat_results[path])
+            digests = hash_cache.get(cache_key)
+            if digests is not None:
+                sha1sums[path] = digests['sha1']
+                continue
+        to_hash.append((path, cache_key))
+    with concurrent.futures.ThreadPoolExecutor(max(jobs, 1)) as executor:
+        hashed = executor.map(hash_file, [path for (path, _) in to_hash])
+        for ((path, cache_key), sha1sum) in zip(to_hash, hashed):
+            sha1sums[path] = sha1sum
+            if cache_key is not None:
+                hash_cache.put(cache_key, {'sha1': sha1sum})
+
+    duplicates = {}
+    for (size, inodes) in by_size.items():
+        if len(inodes) < 2:
+            continue
+        for paths in inodes.values():
+            duplicates.setdefault((size, sha1sums[paths[0]]), []).append(paths[0])
+    return [paths for paths in duplicates.values() if len(paths) > 1]
+
+def replace_with_link(target, path):
+    """Atomically replaces `path` with a hard link to `target`."""
+    temp_path = os.path.join(os.path.dirname(path), '.%s.link' % os.path.basename(path))
+    os.link(target, temp_path)
+    try:
+        os.replace(temp_path, path)
+    except OSError:
+        os.remove(temp_path)
+        raise
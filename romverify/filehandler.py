@@ -1,74 +1,574 @@
+import bz2
+import contextlib
+import errno
+import gzip
 import hashlib
+import io
+import lzma
 import os
 import shutil
+import struct
+import time
 import zipfile
+import zlib
+from . import profiling
+from .compression import COMPRESS_TYPES, zstandard
+
+try:
+    import py7zr
+except ImportError:
+    py7zr = None
+
+DIGEST_KINDS = ('crc32', 'md5', 'sha1', 'sha256')
+
+# Signatures of the compressed formats that are read transparently, besides zip
+STREAM_MAGIC = {
+    'gz': b'\x1f\x8b',
+    'xz': b'\xfd7zXZ\x00',
+    'bz2': b'BZh',
+    '7z': b"7z\xbc\xaf'\x1c",
+    'zstd': b'\x28\xb5\x2f\xfd',
+}
+MAX_MAGIC_LENGTH = max(len(magic) for magic in STREAM_MAGIC.values())
+
+# Errors from reading corrupt or truncated data in any of those formats
+DECODE_ERRORS = (ValueError, EOFError, OSError, lzma.LZMAError, zlib.error)
+if zstandard is not None:
+    DECODE_ERRORS += (zstandard.ZstdError,)
+
+# Files in 7z archives are decompressed in memory, so larger ones are rejected
+MAX_7Z_SIZE = 512 * 1024 * 1024
+
+# Zip record layouts, as in the zipfile module
+STRUCT_FILE_HEADER = '<4s2B4HL2L2H'
+STRUCT_CENTRAL_DIR = '<4s4B4HL2L5H2L'
+STRUCT_END_ARCHIVE = '<4s4H2LH'
+STRUCT_END_ARCHIVE64 = '<4sQ2H2L4Q'
+STRUCT_END_ARCHIVE64_LOCATOR = '<4sLQL'
+
+# Large reads keep the per-chunk overhead low for multi-gigabyte dumps
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+class Crc32:
+    """hashlib-style wrapper for zlib.crc32"""
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return '%08x' % self.value
+
+def new_hasher(kind):
+    if kind == 'crc32':
+        return Crc32()
+    return hashlib.new(kind)
+
+def hash_stream(fp_in, kinds, buf, read_stage='read'):
+    """Hashes a readable stream, using `buf` as the read buffer.
+
+    When profiling, reading is timed as `read_stage` separately from hashing.
+    """
+    hashers = {kind: new_hasher(kind) for kind in kinds}
+    # Read into one reused buffer instead of allocating a new bytes object for every chunk
+    view = memoryview(buf)
+    if profiling.enabled:
+        hash_stream_profiled(fp_in, hashers.values(), buf, read_stage)
+        return {kind: hasher.hexdigest().upper() for (kind, hasher) in hashers.items()}
+    while True:
+        length = fp_in.readinto(buf)
+        if not length:
+            break
+        chunk = view[:length]
+        for hasher in hashers.values():
+            hasher.update(chunk)
+    return {kind: hasher.hexdigest().upper() for (kind, hasher) in hashers.items()}
+
+def hash_stream_profiled(fp_in, hashers, buf, read_stage):
+    view = memoryview(buf)
+    (read_seconds, hash_seconds, total) = (0.0, 0.0, 0)
+    while True:
+        start_time = time.perf_counter()
+        length = fp_in.readinto(buf)
+        read_seconds += time.perf_counter() - start_time
+        if not length:
+            break
+        total += length
+        start_time = time.perf_counter()
+        chunk = view[:length]
+        for hasher in hashers:
+            hasher.update(chunk)
+        hash_seconds += time.perf_counter() - start_time
+    profiling.record(read_stage, read_seconds, total)
+    profiling.record('hash', hash_seconds, total)
+
+class ZstdReader(io.RawIOBase):
+    """Decompresses a zstd file, raising EOFError if it ends partway through a frame.
+
+    zstandard's own stream reader stops at truncated data as if the file had ended there.
+    """
+    def __init__(self, filename):
+        self.fp = open(filename, 'rb')
+        self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        # Decompressed data not read yet, from `offset` on
+        self.pending = b''
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while self.offset >= len(self.pending):
+            if self.decompressor.eof:
+                # A file can hold several frames one after another
+                data = self.decompressor.unused_data or self.fp.read(
+                    zstandard.DECOMPRESSION_RECOMMENDED_INPUT_SIZE)
+                if not data:
+                    return 0
+                self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+            else:
+                data = self.fp.read(zstandard.DECOMPRESSION_RECOMMENDED_INPUT_SIZE)
+                if not data:
+                    raise EOFError(
+                        'Compressed file ended before the end-of-stream marker was reached')
+            self.pending = self.decompressor.decompress(data)
+            self.offset = 0
+        length = min(len(buf), len(self.pending) - self.offset)
+        buf[:length] = self.pending[self.offset:self.offset + length]
+        self.offset += length
+        return length
+
+    def close(self):
+        self.fp.close()
+        super().close()
 
 class FileHandler:
-    # TODO support reading gz,xz,bz2,7z files
     def __init__(self, filename):
         self.filename = filename
-        self.is_zipfile = zipfile.is_zipfile(filename)
+        # The format of single-stream compressed files, like 'gz', or None
+        self.stream_type = None
+        self.is_zipfile = False
+        try:
+            with open(filename, 'rb') as fp_in:
+                # Go by the content rather than the extension, which may well be wrong
+                magic = fp_in.read(MAX_MAGIC_LENGTH)
+                for (stream_type, stream_magic) in STREAM_MAGIC.items():
+                    if magic.startswith(stream_magic):
+                        self.stream_type = stream_type
+                        break
+                else:
+                    self.is_zipfile = zipfile.is_zipfile(fp_in)
+        except OSError:
+            pass
+        # Messages about how the file was handled, for the caller to report
+        self.notes = []
+        # Original files that move copied elsewhere, still to be deleted
+        self.obsolete_files = []
+
+    @property
+    def is_compressed(self):
+        return self.is_zipfile or self.stream_type is not None
 
     def open(self):
+        """Opens the ROM for reading, decompressing it on the fly if needed."""
         if self.is_zipfile:
             with zipfile.ZipFile(self.filename) as zip_fp:
                 namelist = zip_fp.namelist()
                 if len(namelist) != 1:
                     raise ValueError('Invalid name list in zip file: ' + self.filename)
                 return zip_fp.open(namelist[0])
+        elif self.stream_type == 'gz':
+            return gzip.open(self.filename, 'rb')
+        elif self.stream_type == 'xz':
+            return lzma.open(self.filename, 'rb')
+        elif self.stream_type == 'bz2':
+            return bz2.open(self.filename, 'rb')
+        elif self.stream_type == '7z':
+            return self.open_7z()
+        elif self.stream_type == 'zstd':
+            if zstandard is None:
+                raise ValueError(
+                    'Reading zstd files requires the zstandard module: ' + self.filename)
+            return ZstdReader(self.filename)
         else:
             return open(self.filename, 'rb', buffering=0)
 
+    def open_7z(self):
+        if py7zr is None:
+            raise ValueError('Reading 7z files requires the py7zr module: ' + self.filename)
+        try:
+            with py7zr.SevenZipFile(self.filename) as archive:
+                infolist = [info for info in archive.list() if not info.is_directory]
+                if len(infolist) != 1:
+                    raise ValueError('Invalid name list in 7z file: ' + self.filename)
+                # py7zr can only extract to memory, so refuse anything that would exhaust it
+                if infolist[0].uncompressed > MAX_7Z_SIZE:
+                    raise ValueError('Too large to extract from a 7z file: ' + self.filename)
+                member_name = infolist[0].filename
+                factory = py7zr.io.BytesIOFactory(MAX_7Z_SIZE)
+                archive.extract(targets=[member_name], factory=factory)
+                member = factory.get(member_name)
+        except (py7zr.exceptions.ArchiveError, py7zr.exceptions.PasswordRequired) as err:
+            raise ValueError('Unable to read 7z file: %s: %s' % (self.filename, err))
+        except (AttributeError, IndexError, KeyError, TypeError) as err:
+            # py7zr fails on some malformed headers with whatever error it runs into
+            raise ValueError('Unable to read 7z file: %s: %r' % (self.filename, err))
+        member.seek(0)
+        return io.BytesIO(member.read())
+
+    def get_member_info(self):
+        """Returns the ZipInfo of the archived ROM, or None if this isn't a zip file."""
+        if not self.is_zipfile:
+            return None
+        with zipfile.ZipFile(self.filename) as zip_fp:
+            infolist = zip_fp.infolist()
+            if len(infolist) != 1:
+                raise ValueError('Invalid name list in zip file: ' + self.filename)
+            return infolist[0]
+
+    def get_member_infolist(self):
+        """Returns the ZipInfo of every file in a zip archive, in the order they're stored."""
+        with zipfile.ZipFile(self.filename) as zip_fp:
+            return get_stored_files(zip_fp)
+
     def get_sha1sum(self):
-        hasher = hashlib.sha1()
+        return self.get_digests(('sha1',))['sha1']
+
+    def get_member_count(self):
+        if not self.is_zipfile:
+            return 1
+        with zipfile.ZipFile(self.filename) as zip_fp:
+            return sum(1 for info in zip_fp.infolist() if not info.is_dir())
+
+    def get_digests(self, kinds=DIGEST_KINDS, buffer_size=DEFAULT_BUFFER_SIZE):
+        """Computes several checksums in a single pass over the file.
+
+        Returns a dict mapping each of `kinds` (see DIGEST_KINDS) to an uppercase hex digest.
+        """
+        read_stage = 'decompress' if self.is_compressed else 'read'
         with self.open() as fp_in:
-            while True:
-                data = fp_in.read(64*1024)
-                if not data:
-                    break
-                hasher.update(data)
-        sha1sum = hasher.hexdigest().upper()
-        return sha1sum
-
-    def move(self, dest_path, compress_type):
-        if compress_type is not None:
-            #TODO support writing gz/xz/bz2
-            #TODO add an option to set zip's compresslevel (0-9)
-            dest_zip = os.path.splitext(dest_path)[0] + '.zip'
-            dest_basename = os.path.basename(dest_path)
+            return hash_stream(fp_in, kinds, bytearray(buffer_size), read_stage)
 
-            if self.is_zipfile:
-                # Don't mess with an existing zipfile if its filename is good
-                #TODO an option to force a rewrite may be useful for better compression settings
-                with zipfile.ZipFile(self.filename) as zf_in:
-                    file_list = zf_in.namelist()
-                    if len(file_list) == 1 and file_list[0] == dest_basename:
-                        shutil.move(self.filename, dest_zip)
-                        print('  Keeping original zip file')
-                        return dest_zip
-                # zipfile needs the uncompressed input files to be either in memory or on disk
-                # as a regular file, not a file-like object.
-                # This extracted data can be too large for RAM or some systems' tmpfs, so we
-                # put it in the same directory (and filesystem) as the result zip.
-                with open(dest_path, 'wb') as ext_fp:
-                    shutil.copyfileobj(self.open(), ext_fp)
-                os.remove(self.filename)
-                self.filename = dest_path
-            # Create the resulting zip file
-            with zipfile.ZipFile(dest_zip, 'w', zipfile.ZIP_DEFLATED) as zip_out:
-                zip_out.write(self.filename, dest_basename)
-            os.remove(self.filename)
-            self.filename = dest_zip
-            self.is_zipfile = True
+    def get_member_digests(self, kinds=DIGEST_KINDS, buffer_size=DEFAULT_BUFFER_SIZE):
+        """Hashes every file in a zip archive, in the order they're stored in it.
+
+        Returns a list of (member name, digests) with digests as returned by get_digests.
+        """
+        buf = bytearray(buffer_size)
+        members = []
+        with zipfile.ZipFile(self.filename) as zip_fp:
+            for member_info in get_stored_files(zip_fp):
+                with zip_fp.open(member_info) as fp_in:
+                    members.append(
+                        (member_info.filename, hash_stream(fp_in, kinds, buf, 'decompress')))
+        return members
+
+    def move(self, dest_path, compress_type, level=None, keep_source=False):
+        """Moves the ROM to dest_path, compressed as one of COMPRESS_TYPES or None to extract.
+
+        The extension for the compression type is added to dest_path.
+        Archives of a game made of several files are always kept as zip files.
+        New files are written under a temporary name and synced before they're renamed into
+        place, so a crash never leaves a partial file at the destination.
+        With keep_source, an original that was copied rather than renamed is left in place
+        and listed in self.obsolete_files, for the caller to delete once the destination
+        directory is synced. Returns the resulting path.
+        """
+        destination = self.write_moved(dest_path, compress_type, level)
+        if not keep_source:
+            self.remove_obsolete()
+        return destination
+
+    def write_moved(self, dest_path, compress_type, level):
+        if self.get_member_count() > 1:
+            dest_zip = os.path.splitext(dest_path)[0] + '.zip'
+            self.move_source(dest_zip)
+            self.notes.append('Keeping original zip file')
             return dest_zip
+        if compress_type in ('zip', 'store'):
+            return self.move_zip(dest_path, compress_type, level)
+        elif compress_type is not None:
+            dest_file = dest_path + COMPRESS_TYPES[compress_type]
+            if self.stream_type == compress_type and level is None:
+                self.move_source(dest_file)
+                self.notes.append('Keeping original %s file' % compress_type)
+            else:
+                with atomic_output(dest_file) as temp_file:
+                    with self.open() as in_fp:
+                        with open_compressed(temp_file, compress_type, level) as out_fp:
+                            copy_stream(in_fp, out_fp, 'compress')
+                self.replaced_by(dest_file)
+            self.is_zipfile = False
+            self.stream_type = compress_type if compress_type in STREAM_MAGIC else None
+            return dest_file
         else:
             if self.is_zipfile:
-                # Extract the uncompressed file
-                with open(dest_path, 'wb') as out_fp:
-                    with self.open() as in_fp:
-                        shutil.copyfileobj(in_fp, out_fp)
-                os.remove(self.filename)
+                member_info = self.get_member_info()
+                with atomic_output(dest_path) as temp_path:
+                    with open(temp_path, 'wb', buffering=0) as out_fp:
+                        if member_info.compress_type == zipfile.ZIP_STORED and \
+                                not member_info.flag_bits & 0x1:
+                            # Copy the stored data straight out of the archive
+                            with open(self.filename, 'rb', buffering=0) as in_fp:
+                                offset = get_member_data_offset(in_fp, member_info)
+                                copy_range(in_fp.fileno(), out_fp.fileno(),
+                                           offset, member_info.compress_size)
+                        else:
+                            # Extract the uncompressed file
+                            with self.open() as in_fp:
+                                copy_stream(in_fp, out_fp, 'extract')
+                self.replaced_by(dest_path)
+                self.is_zipfile = False
+            elif self.stream_type is not None:
+                with atomic_output(dest_path) as temp_path:
+                    with open(temp_path, 'wb', buffering=0) as out_fp:
+                        with self.open() as in_fp:
+                            copy_stream(in_fp, out_fp, 'extract')
+                self.replaced_by(dest_path)
+                self.stream_type = None
             else:
-                shutil.move(self.filename, dest_path)
-            self.filename = dest_path
+                self.move_source(dest_path)
             return dest_path
+
+    def move_zip(self, dest_path, compress_type, level):
+        dest_zip = os.path.splitext(dest_path)[0] + '.zip'
+        dest_basename = os.path.basename(dest_path)
+        compress_method = zipfile.ZIP_STORED if compress_type == 'store' else zipfile.ZIP_DEFLATED
+
+        if self.is_zipfile:
+            # Don't mess with an existing zipfile if its filename is good, unless asked for a
+            # specific compression level or to store data that's currently compressed
+            member_info = self.get_member_info()
+            reusable = level is None and not member_info.flag_bits & 0x1 and \
+                compress_method in (zipfile.ZIP_DEFLATED, member_info.compress_type)
+            if reusable and member_info.filename == dest_basename:
+                self.move_source(dest_zip)
+                self.notes.append('Keeping original zip file')
+            elif reusable:
+                # Only the member name is wrong, so reuse the compressed data as is
+                with atomic_output(dest_zip) as temp_zip:
+                    copy_zip_member(self.filename, member_info, temp_zip, dest_basename)
+                self.replaced_by(dest_zip)
+            else:
+                self.recompress(dest_zip, dest_basename, compress_method, level)
+            return dest_zip
+        self.recompress(dest_zip, dest_basename, compress_method, level)
+        return dest_zip
+
+    def recompress(self, dest_zip, dest_basename, compress_method, level):
+        input_path = self.filename
+        if self.is_compressed:
+            # zipfile needs the uncompressed input files to be either in memory or on disk
+            # as a regular file, not a file-like object.
+            # This extracted data can be too large for RAM or some systems' tmpfs, so we
+            # put it in the same directory (and filesystem) as the result zip.
+            input_path = get_temp_path(os.path.join(os.path.dirname(dest_zip), dest_basename))
+            with open(input_path, 'wb') as ext_fp:
+                with self.open() as in_fp:
+                    copy_stream(in_fp, ext_fp, 'extract')
+        try:
+            # Create the resulting zip file
+            with atomic_output(dest_zip) as temp_zip:
+                with zipfile.ZipFile(temp_zip, 'w', compress_method,
+                                     compresslevel=level) as zip_out:
+                    with profiling.stage('zip write') as timer:
+                        zip_out.write(input_path, dest_basename)
+                        if profiling.enabled:
+                            timer.add_bytes(zip_out.getinfo(dest_basename).file_size)
+        finally:
+            if input_path != self.filename:
+                os.remove(input_path)
+        self.replaced_by(dest_zip)
+        self.is_zipfile = True
+        self.stream_type = None
+
+    def move_source(self, dest_path):
+        """Renames the file to dest_path, or copies it there if it's on another filesystem."""
+        if not move_file(self.filename, dest_path):
+            self.replaced_by(dest_path)
+        self.filename = dest_path
+
+    def replaced_by(self, dest_path):
+        """Records that the file's contents now live at dest_path, which becomes self.filename.
+
+        The original is listed in self.obsolete_files unless dest_path was written over it.
+        """
+        if os.path.abspath(self.filename) != os.path.abspath(dest_path):
+            self.obsolete_files.append(self.filename)
+        self.filename = dest_path
+
+    def remove_obsolete(self):
+        """Deletes the originals of moved files, once their new directory is synced."""
+        if self.obsolete_files:
+            sync_path(os.path.dirname(os.path.abspath(self.filename)))
+        for filename in self.obsolete_files:
+            os.remove(filename)
+        self.obsolete_files = []
+
+def get_temp_path(dest_path):
+    """Returns the hidden name a file is written under in its directory until it's complete."""
+    return os.path.join(os.path.dirname(dest_path), '.%s.part' % os.path.basename(dest_path))
+
+@contextlib.contextmanager
+def atomic_output(dest_path):
+    """Context manager giving a temporary path to write the contents of dest_path to.
+
+    When the block completes, the file is synced to disk and renamed to dest_path, which
+    either keeps its old contents or gets the complete new ones if the system crashes.
+    The temporary file is deleted if the block raises an exception.
+    """
+    temp_path = get_temp_path(dest_path)
+    try:
+        yield temp_path
+        with profiling.stage('fsync'):
+            sync_path(temp_path)
+        os.replace(temp_path, dest_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+def sync_path(path):
+    """Flushes a file's data, or a directory's entries, to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def get_stored_files(zip_fp):
+    # Reading in storage order makes hashing a single sequential pass over the archive
+    return sorted((info for info in zip_fp.infolist() if not info.is_dir()),
+                  key=lambda info: info.header_offset)
+
+def open_compressed(filename, compress_type, level=None):
+    """Opens a file for writing through a single-stream compressor."""
+    if compress_type == 'gz':
+        return gzip.open(filename, 'wb', compresslevel=9 if level is None else level)
+    if compress_type == 'xz':
+        return lzma.open(filename, 'wb', preset=level)
+    if compress_type == 'bz2':
+        return bz2.open(filename, 'wb', compresslevel=9 if level is None else level)
+    if compress_type == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+        return compressor.stream_writer(open(filename, 'wb'))
+    raise ValueError('Unsupported compression type: ' + compress_type)
+
+def copy_stream(in_fp, out_fp, stage_name):
+    """Copies the rest of a stream through a buffer, timed as a profiling stage."""
+    with profiling.stage(stage_name) as timer:
+        shutil.copyfileobj(in_fp, out_fp, DEFAULT_BUFFER_SIZE)
+        if profiling.enabled:
+            timer.add_bytes(in_fp.tell())
+
+def copy_range(fd_in, fd_out, offset, count):
+    """Copies `count` bytes of fd_in from `offset` to the current position of fd_out.
+
+    The data is copied within the kernel when possible, which also lets filesystems that
+    support it share the underlying blocks instead of writing them again.
+    """
+    methods = []
+    if hasattr(os, 'copy_file_range'):
+        methods.append(lambda count: os.copy_file_range(fd_in, fd_out, count, offset))
+    if hasattr(os, 'sendfile'):
+        methods.append(lambda count: os.sendfile(fd_out, fd_in, offset, count))
+    methods.append(lambda count: os.write(fd_out, os.pread(fd_in, count, offset)))
+    with profiling.stage('copy', count):
+        for method in methods:
+            try:
+                while count > 0:
+                    length = method(min(count, 1 << 30))
+                    if length == 0:
+                        raise OSError('Unexpected end of file while copying')
+                    offset += length
+                    count -= length
+                return
+            except OSError:
+                # Not supported between these files, so continue where this one left off
+                if method is methods[-1]:
+                    raise
+
+def move_file(src_path, dest_path):
+    """Moves a file, with a rename if possible or by copying it within the kernel otherwise.
+
+    Returns True if the file was renamed, or False if it was copied to another filesystem,
+    in which case src_path is left for the caller to delete.
+    """
+    try:
+        with profiling.stage('rename'):
+            os.rename(src_path, dest_path)
+        return True
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+    with atomic_output(dest_path) as temp_path:
+        with open(src_path, 'rb', buffering=0) as in_fp:
+            with open(temp_path, 'wb', buffering=0) as out_fp:
+                copy_range(in_fp.fileno(), out_fp.fileno(), 0,
+                           os.fstat(in_fp.fileno()).st_size)
+        shutil.copystat(src_path, temp_path)
+    return False
+
+def get_member_data_offset(zip_fp, member_info):
+    """Returns the offset of a zip member's compressed data, which follows its local header."""
+    zip_fp.seek(member_info.header_offset)
+    header = struct.unpack(STRUCT_FILE_HEADER, zip_fp.read(struct.calcsize(STRUCT_FILE_HEADER)))
+    if header[0] != b'PK\x03\x04':
+        raise zipfile.BadZipFile('Bad local file header in ' + member_info.filename)
+    return member_info.header_offset + struct.calcsize(STRUCT_FILE_HEADER) + \
+        header[10] + header[11]
+
+def copy_zip_member(src_path, member_info, dest_zip, new_name):
+    """Writes a new single-member zip with the compressed data of a member of another zip.
+
+    This renames an archived ROM without inflating and deflating it again.
+    """
+    try:
+        name = new_name.encode('ascii')
+        flag_bits = member_info.flag_bits & ~0x808
+    except UnicodeEncodeError:
+        name = new_name.encode('utf-8')
+        flag_bits = (member_info.flag_bits & ~0x808) | 0x800
+    file_size = member_info.file_size
+    compress_size = member_info.compress_size
+    extra = b''
+    if file_size > zipfile.ZIP64_LIMIT or compress_size > zipfile.ZIP64_LIMIT:
+        extra = struct.pack('<2H2Q', 1, 16, file_size, compress_size)
+        file_size = compress_size = 0xffffffff
+    cd_offset = struct.calcsize(STRUCT_FILE_HEADER) + len(name) + len(extra) + \
+        member_info.compress_size
+    zip64 = bool(extra) or cd_offset > zipfile.ZIP64_LIMIT
+    version = max(member_info.extract_version, 45 if zip64 else 20)
+    date_time = member_info.date_time
+    dosdate = (date_time[0] - 1980) << 9 | date_time[1] << 5 | date_time[2]
+    dostime = date_time[3] << 11 | date_time[4] << 5 | (date_time[5] // 2)
+
+    with open(src_path, 'rb', buffering=0) as in_fp:
+        data_offset = get_member_data_offset(in_fp, member_info)
+        with open(dest_zip, 'wb', buffering=0) as out_fp:
+            out_fp.write(struct.pack(
+                STRUCT_FILE_HEADER, b'PK\x03\x04', version, 0, flag_bits,
+                member_info.compress_type, dostime, dosdate, member_info.CRC,
+                compress_size, file_size, len(name), len(extra)) + name + extra)
+            copy_range(in_fp.fileno(), out_fp.fileno(), data_offset, member_info.compress_size)
+            central_dir = struct.pack(
+                STRUCT_CENTRAL_DIR, b'PK\x01\x02', max(member_info.create_version, version),
+                member_info.create_system, version, 0, flag_bits, member_info.compress_type,
+                dostime, dosdate, member_info.CRC, compress_size, file_size, len(name),
+                len(extra), 0, 0, member_info.internal_attr, member_info.external_attr,
+                0) + name + extra
+            end = b''
+            if zip64:
+                end += struct.pack(
+                    STRUCT_END_ARCHIVE64, b'PK\x06\x06', 44, 45, 45, 0, 0, 1, 1,
+                    len(central_dir), cd_offset)
+                end += struct.pack(
+                    STRUCT_END_ARCHIVE64_LOCATOR, b'PK\x06\x07', 0,
+                    cd_offset + len(central_dir), 1)
+            end += struct.pack(
+                STRUCT_END_ARCHIVE, b'PK\x05\x06', 0, 0, 1, 1, len(central_dir),
+                min(cd_offset, 0xffffffff), 0)
+            out_fp.write(central_dir + end)
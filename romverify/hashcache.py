@@ -0,0 +1,150 @@
+import os
+import sqlite3
+import sys
+import time
+from .datindex import get_store_file, open_store
+
+SCHEMA_VERSION = 2
+
+# Digest columns of the hashes table, the same kinds as filehandler.DIGEST_KINDS
+CACHED_DIGESTS = ('crc32', 'md5', 'sha1', 'sha256')
+
+SCHEMA = '''
+DROP TABLE IF EXISTS hashes;
+CREATE TABLE hashes (
+    device INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    member_crc INTEGER NOT NULL,
+    member_size INTEGER NOT NULL,
+    crc32 TEXT,
+    md5 TEXT,
+    sha1 TEXT,
+    sha256 TEXT,
+    last_used INTEGER NOT NULL,
+    PRIMARY KEY (device, inode, size, mtime_ns, member_crc, member_size)
+);
+CREATE INDEX hashes_last_used ON hashes (last_used);
+'''
+
+# Least recently used entries beyond this are evicted whenever the cache is closed
+DEFAULT_MAX_ENTRIES = 1000000
+DEFAULT_MAX_AGE_DAYS = 90
+
+# Entries found in the cache get their last_used time updated in batches of this many
+TOUCH_BATCH = 1000
+
+def get_cache_file():
+    return get_store_file('rom_hashes.sqlite')
+
+def get_cache_key(stat_result, member_info=None):
+    """Returns a key that identifies the current contents of a regular file.
+
+    Any write to the file changes its mtime or size, and a different file at the same path
+    has a different inode. For zip files, the member's CRC and size are part of the key.
+    """
+    member_crc = -1
+    member_size = -1
+    if member_info is not None:
+        member_crc = member_info.CRC
+        member_size = member_info.file_size
+    return (stat_result.st_dev, stat_result.st_ino, stat_result.st_size,
+            stat_result.st_mtime_ns, member_crc, member_size)
+
+class HashCache:
+    """Persistent cache of ROM checksums, so that unchanged files never need to be re-read."""
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = get_cache_file()
+        self.filename = filename
+        self.db = open_store(filename, SCHEMA, SCHEMA_VERSION)
+        # Other runs can keep reading while this one writes
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        self.now = int(time.time())
+        # Keys of entries that were used, whose last_used time is still to be updated
+        self.touched = []
+        # Set when another run kept the database locked, after which changes are skipped
+        self.read_only = False
+
+    def close(self):
+        self.flush()
+        self.prune(max_entries=DEFAULT_MAX_ENTRIES)
+        self.db.close()
+
+    def write(self, sql, params=(), many=False):
+        """Runs a statement that changes the cache and commits it right away.
+
+        The database is only locked against other runs for that long. If another run holds
+        the lock too long, this and any later changes are skipped rather than failing this run
+        or waiting on every file. Returns the cursor, or None if the change was skipped.
+        """
+        if self.read_only:
+            return None
+        try:
+            if many:
+                cursor = self.db.executemany(sql, params)
+            else:
+                cursor = self.db.execute(sql, params)
+            self.db.commit()
+            return cursor
+        except sqlite3.OperationalError as err:
+            self.db.rollback()
+            print('WARNING: Not updating the checksum cache for the rest of this run:', err,
+                  file=sys.stderr)
+            self.read_only = True
+            return None
+
+    def flush(self):
+        """Records when the entries found in the cache were last used."""
+        if self.touched:
+            self.write(
+                'UPDATE hashes SET last_used = ? WHERE device = ? AND inode = ? AND ' +
+                'size = ? AND mtime_ns = ? AND member_crc = ? AND member_size = ?',
+                [(self.now,) + key for key in self.touched], many=True)
+            self.touched = []
+
+    def get(self, key, kinds=('sha1',)):
+        """Returns {kind: hex digest} for a cache key, or None unless all `kinds` are cached."""
+        try:
+            row = self.db.execute(
+                'SELECT crc32, md5, sha1, sha256 FROM hashes WHERE device = ? AND inode = ? ' +
+                'AND size = ? AND mtime_ns = ? AND member_crc = ? AND member_size = ?',
+                key).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        if row is None:
+            return None
+        digests = {kind: value for (kind, value) in zip(CACHED_DIGESTS, row) if value is not None}
+        if not digests.keys() >= set(kinds):
+            return None
+        self.touched.append(key)
+        if len(self.touched) >= TOUCH_BATCH:
+            self.flush()
+        return digests
+
+    def put(self, key, digests):
+        self.write(
+            'INSERT OR REPLACE INTO hashes (device, inode, size, mtime_ns, member_crc, ' +
+            'member_size, crc32, md5, sha1, sha256, last_used) VALUES (?,?,?,?,?,?,?,?,?,?,?)',
+            key + tuple(digests.get(kind) for kind in CACHED_DIGESTS) + (self.now,))
+
+    def prune(self, max_age_days=None, max_entries=None):
+        """Evicts entries unused for `max_age_days` and all but the `max_entries` most recent.
+
+        Returns the number of entries removed.
+        """
+        removed = 0
+        if max_age_days is not None:
+            cutoff = self.now - int(max_age_days * 24 * 60 * 60)
+            cursor = self.write('DELETE FROM hashes WHERE last_used < ?', (cutoff,))
+            removed += cursor.rowcount if cursor is not None else 0
+        if max_entries is not None:
+            count = self.db.execute('SELECT count(*) FROM hashes').fetchone()[0]
+            if count > max_entries:
+                cursor = self.write(
+                    'DELETE FROM hashes WHERE last_used < (SELECT last_used FROM hashes ' +
+                    'ORDER BY last_used DESC LIMIT 1 OFFSET ?)', (max_entries,))
+                removed += cursor.rowcount if cursor is not None else 0
+        return removed
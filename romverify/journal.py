@@ -0,0 +1,124 @@
+import json
+import os
+from .datindex import get_store_file, open_store
+from .romsorter import RomResult
+from .scanner import get_signature
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+DROP TABLE IF EXISTS moves;
+CREATE TABLE moves (
+    source TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    dest_path TEXT NOT NULL,
+    compress_type TEXT,
+    compress_level INTEGER,
+    result TEXT NOT NULL,
+    destination TEXT
+);
+'''
+
+# What's kept of a RomResult to report and redo its move, besides its filename and members
+RESULT_FIELDS = ('digests', 'console', 'rom_name', 'game', 'set_status', 'notes', 'size',
+                 'is_raw')
+
+def get_journal_file():
+    return get_store_file('rom_moves.sqlite')
+
+def dump_result(result):
+    """Returns the match of a RomResult as a JSON-serializable dict."""
+    fields = {name: getattr(result, name) for name in RESULT_FIELDS}
+    fields['filename'] = result.filename
+    fields['members'] = [dump_result(member) for member in result.members]
+    return fields
+
+def load_result(fields):
+    result = RomResult(fields['filename'])
+    for name in RESULT_FIELDS:
+        setattr(result, name, fields.get(name, getattr(result, name)))
+    result.members = [load_result(member) for member in fields.get('members', [])]
+    return result
+
+class MoveJournal:
+    """Record of the moves made by an `organize` or `rename` run, so an interrupted one can resume.
+
+    Each move is recorded before it starts, along with the matched RomResult it came from, and
+    marked completed once its destination directory is synced. Resuming redoes the moves that
+    never completed without hashing their files again, and skips every file already handled.
+    Only one run can use the journal at a time: opening it raises BlockingIOError while
+    another process has it open.
+    """
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = get_journal_file()
+        self.filename = filename
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.lock_fp = open(filename + '.lock', 'w')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self.lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self.lock_fp.close()
+                raise
+        self.db = open_store(filename, SCHEMA, SCHEMA_VERSION)
+        # Every entry is committed on its own, so commits only need to survive the process
+        # being killed, not a power loss. Moves are safe to redo either way.
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        # Absolute paths of source files that resuming took care of
+        self.handled = set()
+
+    def close(self):
+        self.db.close()
+        # Closing releases the lock
+        self.lock_fp.close()
+
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM moves').fetchone()[0]
+
+    def clear(self):
+        self.db.execute('DELETE FROM moves')
+        self.db.commit()
+        self.handled.clear()
+
+    def is_handled(self, filename):
+        return os.path.abspath(filename) in self.handled
+
+    def plan(self, result, dest_path, compress_type, compress_level):
+        """Records that the file of a RomResult is about to be moved to dest_path."""
+        signature = get_signature(result.filename)
+        if signature is None:
+            return
+        self.db.execute(
+            'INSERT OR REPLACE INTO moves VALUES (?, ?, ?, ?, ?, ?, ?, NULL)',
+            (os.path.abspath(result.filename), *signature, os.path.abspath(dest_path),
+             compress_type, compress_level, json.dumps(dump_result(result))))
+        self.db.commit()
+
+    def complete(self, moves):
+        """Marks moves as done, given (source, destination) pairs whose files are synced."""
+        self.db.executemany(
+            'UPDATE moves SET destination = ? WHERE source = ?',
+            [(destination, os.path.abspath(source)) for (source, destination) in moves])
+        self.db.commit()
+
+    def get_moves(self):
+        """Returns the recorded moves as a list of (source, (size, mtime_ns), dest_path,
+        compress type, compress level, RomResult, destination or None if not completed).
+
+        Their sources count as handled from then on.
+        """
+        moves = []
+        for (source, size, mtime_ns, dest_path, compress_type, compress_level, result,
+             destination) in self.db.execute('SELECT * FROM moves ORDER BY rowid'):
+            moves.append((source, (size, mtime_ns), dest_path, compress_type, compress_level,
+                          load_result(json.loads(result)), destination))
+            self.handled.add(source)
+        return moves
@@ -2,14 +2,70 @@
 import argparse
 import os
 import sys
-from romverify.config import Config
-from romverify.romsorter import RomSorter, set_sorting_dir
-from romverify.datfiles import DatReader, install_dat_file
+from romverify import profiling
+from romverify.compression import COMPRESS_LEVELS, COMPRESS_TYPES
+from romverify.hashcache import DEFAULT_MAX_AGE_DAYS, DEFAULT_MAX_ENTRIES
+from romverify.report import REPORT_FORMATS
+
+# Everything else is imported by the subcommands that need it, so that quick ones like `list`
+# don't pay for loading zipfile, hashlib, ElementTree or the worker pools.
 
 #TODO use config files for default options
-#TODO support DAT lists that have more than one file in a single game (eg PS2, 3DS Digital)
 #TODO option to only check one console by name (for organize/rename/check)
 
+def add_worker_arguments(parser, reporting=True):
+    """Adds the options for hashing files in parallel and with the cache.
+
+    With `reporting`, also adds those of the subcommands that report on every file.
+    """
+
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='Number of files to hash in parallel (default: 1)')
+    parser.add_argument(
+        '--no-cache', action='store_false', dest='use_cache',
+        help="Don't use or update the cache of previously computed checksums")
+    if not reporting:
+        return
+    parser.add_argument(
+        '--processes', action='store_true',
+        help='Hash uncompressed files with worker processes too, instead of threads')
+    parser.add_argument(
+        '--format', choices=REPORT_FORMATS, default='text',
+        help='Output format: readable text, or one JSON object or CSV row per file, ' +
+        'followed by a summary (default: text)')
+
+def add_hashing_arguments(parser):
+    """Adds the options shared by every subcommand that hashes ROM files."""
+
+    add_worker_arguments(parser)
+    parser.add_argument(
+        '-r', '--recursive', action='store_true',
+        help='Verify all files within any given directories and their subdirectories')
+    parser.add_argument(
+        '--include', action='append', metavar='GLOB',
+        help='With --recursive, only verify files whose names match this pattern')
+    parser.add_argument(
+        '--exclude', action='append', metavar='GLOB',
+        help='With --recursive, skip files and directories whose names match this pattern')
+    parser.add_argument(
+        '--max-depth', type=int, metavar='N',
+        help='With --recursive, descend at most N levels of subdirectories')
+
+def add_compress_arguments(parser):
+    """Adds the options for how `organize` and `rename` compress their output."""
+
+    parser.add_argument(
+        '--compress', choices=list(COMPRESS_TYPES) + ['none'], default='zip',
+        help="Output format for matched ROMs (default: zip). 'store' is a zip without " +
+        "compression, for ROMs that are already compressed.")
+    parser.add_argument(
+        '--no-compress', action='store_const', dest='compress', const='none',
+        help='Disables compression, same as `--compress none`')
+    parser.add_argument(
+        '--level', type=int,
+        help='Compression level. Zipped ROMs are recompressed when this is given.')
+
 def parser_organize(subparsers):
     """Adds parser for the `organize` subcommand."""
 
@@ -18,15 +74,18 @@ def parser_organize(subparsers):
         'in DAT files and moving them to the appropriate collections directory, if applicable.'
     parser = subparsers.add_parser('organize', description=subhelp, help=subhelp)
     parser.add_argument('files', metavar='file', nargs='+', help='Source ROM files')
-    parser.add_argument(
-        '--no-compress', action='store_true',
-        help='Disables zip compression')
+    add_compress_arguments(parser)
     parser.add_argument(
         '-d', '--dat', dest='datfile',
         help='Source DAT file from No-Intro. Ignores installed DATs.')
     parser.add_argument(
         '-o', '--output-dir',
         help='Destination directory for matching ROMs (overrides collection)')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='Finish the moves of an interrupted run without hashing those files again, ' +
+        'then process the remaining files')
+    add_hashing_arguments(parser)
 
 def parser_rename(subparsers):
     """Adds parser for the `rename` subcommand."""
@@ -36,12 +95,15 @@ def parser_rename(subparsers):
         'in DAT files.'
     parser = subparsers.add_parser('rename', description=subhelp, help=subhelp)
     parser.add_argument('files', metavar='file', nargs='+', help='Source ROM files')
-    parser.add_argument(
-        '--no-compress', action='store_true', dest='no_compress',
-        help='Disables zip compression')
+    add_compress_arguments(parser)
     parser.add_argument(
         '-d', '--dat', dest='datfile',
         help='Source DAT file from No-Intro. Ignores installed DATs.')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='Finish the moves of an interrupted run without hashing those files again, ' +
+        'then process the remaining files')
+    add_hashing_arguments(parser)
 
 def parser_check(subparsers):
     """Adds parser for the `check` subcommand."""
@@ -54,6 +116,13 @@ def parser_check(subparsers):
     parser.add_argument(
         '-d', '--dat', dest='datfile',
         help='Source DAT file from No-Intro. Ignores installed DATs.')
+    parser.add_argument(
+        '--fast', action='store_true',
+        help='Match zipped ROMs by the CRC32 and size in the zip without decompressing them')
+    parser.add_argument(
+        '--strict', action='store_true',
+        help='With --fast, confirm CRC32 matches with a full SHA-1 checksum')
+    add_hashing_arguments(parser)
 
 def parsers_collection(subparsers):
     """Adds parser for the `collection-` subcommands."""
@@ -77,9 +146,23 @@ def parsers_collection(subparsers):
     sub_c_mis = subparsers.add_parser(
         'collection-missing', description=help_c_mis, help=help_c_mis)
     sub_c_mis.add_argument('console', metavar='console_name')
+    add_audit_arguments(sub_c_mis)
+
+    help_c_str = \
+        "Lists all files in the specified console's collection directory that don't match " + \
+        "any game in its DAT."
+    sub_c_str = subparsers.add_parser(
+        'collection-strays', description=help_c_str, help=help_c_str)
+    sub_c_str.add_argument('console', metavar='console_name')
+    sub_c_str.add_argument(
+        '-m', '--move-to', metavar='DIR',
+        help='Move the stray files out of the collection into this directory')
+    add_audit_arguments(sub_c_str)
 
-    # TODO add subcommand 'collection-strays' to list (and optionally move) files that are
-    #      present in but don't belong in the collection directory
+def add_audit_arguments(parser):
+    """Adds the options shared by the collection audit subcommands."""
+
+    add_worker_arguments(parser, reporting=False)
 
 def parsers_dat(subparsers):
     """Adds parser for the `dat-` subcommands."""
@@ -89,7 +172,9 @@ def parsers_dat(subparsers):
         'of `organize` and `rename`. Replaces any existing DAT file for the same console ' + \
         'unless the specified DAT file is older and `--force` is not given.'
     sub_d_add = subparsers.add_parser('dat-add', description=help_d_add, help=help_d_add)
-    sub_d_add.add_argument('datfile', nargs='+')
+    sub_d_add.add_argument(
+        'datfile', nargs='+',
+        help='DAT file, or a zip of many such as the No-Intro daily pack')
     sub_d_add.add_argument(
         '-f', '--force', action='store_true',
         help='Allow overwriting newer DAT files with older ones')
@@ -107,11 +192,83 @@ def parser_list(subparsers):
         'Lists all consoles with an installed DAT and any associated collection directory'
     subparsers.add_parser('list', description=subhelp, help=subhelp)
 
+def parser_cache_prune(subparsers):
+    """Adds parser for the `cache-prune` subcommand."""
+
+    subhelp = \
+        'Removes old entries from the cache of checksums for previously verified files'
+    parser = subparsers.add_parser('cache-prune', description=subhelp, help=subhelp)
+    parser.add_argument(
+        '--max-age', type=float, default=DEFAULT_MAX_AGE_DAYS, metavar='DAYS',
+        help='Remove entries unused for this many days (default: %(default)s)')
+    parser.add_argument(
+        '--max-entries', type=int, default=DEFAULT_MAX_ENTRIES,
+        help='Keep at most this many of the most recently used entries ' +
+        '(default: %(default)s)')
+
+def parser_watch(subparsers):
+    """Adds parser for the `watch` subcommand."""
+
+    subhelp = \
+        'Watches a directory and organizes ROM files as soon as they are dropped into it, ' + \
+        'reloading DAT files whenever new ones are installed.'
+    parser = subparsers.add_parser('watch', description=subhelp, help=subhelp)
+    parser.add_argument('directory', help='Drop directory to watch')
+    add_compress_arguments(parser)
+    parser.add_argument(
+        '-o', '--output-dir',
+        help='Destination directory for matching ROMs (overrides collection)')
+    parser.add_argument(
+        '--settle', type=float, default=2.0, metavar='SECONDS',
+        help='Wait until a file has stopped changing for this long (default: %(default)s)')
+    parser.add_argument(
+        '--poll', type=float, metavar='SECONDS',
+        help='Scan the directory at this interval instead of using inotify')
+    add_worker_arguments(parser)
+
+def parser_dedupe(subparsers):
+    """Adds parser for the `dedupe` subcommand."""
+
+    subhelp = \
+        'Finds identical files among the given files and directories, and optionally ' + \
+        'hard links or removes the extra copies. The first copy found is kept, so list ' + \
+        'preferred locations first; collection directories come before other paths.'
+    parser = subparsers.add_parser('dedupe', description=subhelp, help=subhelp)
+    parser.add_argument('paths', metavar='path', nargs='*', help='Files or directories')
+    parser.add_argument(
+        '-c', '--collections', action='store_true',
+        help='Also search the collection directories of every console')
+    action = parser.add_mutually_exclusive_group()
+    action.add_argument(
+        '--hardlink', action='store_true',
+        help='Replace each extra copy with a hard link to the kept one')
+    action.add_argument(
+        '--remove', action='store_true', help='Delete each extra copy')
+    parser.add_argument(
+        '--include', action='append', metavar='GLOB',
+        help='Only consider files whose names match this pattern')
+    parser.add_argument(
+        '--exclude', action='append', metavar='GLOB',
+        help='Skip files and directories whose names match this pattern')
+    add_worker_arguments(parser, reporting=False)
+
 def parse_args():
     """Parses commandline arguments."""
 
     parser = argparse.ArgumentParser(
         description='Verifies and organizes ROMs with No-Intro DAT files.')
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='Print how long each stage took, like DAT parsing, reading and hashing')
+    parser.add_argument(
+        '--profile-output', metavar='FILE',
+        help='Write the stage timings to FILE as JSON instead of printing them')
+    parser.add_argument(
+        '--cprofile', metavar='FILE',
+        help='Run under cProfile and save its statistics to FILE for pstats')
+    parser.add_argument(
+        '--tracemalloc', action='store_true',
+        help='Trace memory allocations and report the peak and top allocation sites')
     subparsers = parser.add_subparsers(
         dest='subcommand', metavar='subcommand',
         description='Show extended help on each subcommand with `<subcommand> -h`')
@@ -122,45 +279,259 @@ def parse_args():
     parsers_collection(subparsers)
     parsers_dat(subparsers)
     parser_list(subparsers)
+    parser_cache_prune(subparsers)
+    parser_watch(subparsers)
+    parser_dedupe(subparsers)
 
     args = parser.parse_args()
+    if getattr(args, 'level', None) is not None and args.compress in COMPRESS_LEVELS:
+        (min_level, max_level) = COMPRESS_LEVELS[args.compress]
+        if not min_level <= args.level <= max_level:
+            parser.error('--level must be from %d to %d for --compress %s' % (
+                min_level, max_level, args.compress))
     return args
 
-def verify_roms(files, action, datfile=None, compress_type='zip', outdir=None):
+def get_sorter_options(args):
+    """Returns RomSorter keyword arguments for the options from add_hashing_arguments."""
+
+    from romverify.scanner import FileScanner
+
+    scanner = FileScanner(
+        recursive=args.recursive, include=args.include, exclude=args.exclude,
+        max_depth=args.max_depth)
+    return {
+        'jobs': args.jobs, 'use_processes': args.processes, 'scanner': scanner,
+        'report_format': args.format}
+
+def verify_roms(files, action, datfile=None, compress_type='zip', outdir=None, use_cache=True,
+                report_format='text', resume=False, **sorter_options):
     """Verifies ROM checksums and optionally uses them to rename or move the ROMs."""
 
+    import signal
+    from romverify.datfiles import DatReader
+    from romverify.hashcache import HashCache
+    from romverify.journal import MoveJournal
+    from romverify.report import create_report
+    from romverify.romsorter import RomSorter
+
     reader = DatReader()
     if datfile is not None:
         (dat_console, dat_version) = reader.readfile(datfile)
         if dat_console is None:
-            print('Invalid DAT file:', datfile)
+            print('Invalid DAT file:', datfile, file=sys.stderr)
             return
-        print('Checking console:', dat_console)
-        print('DAT version:', dat_version)
+        if report_format == 'text':
+            print('Checking console:', dat_console)
+            print('DAT version:', dat_version)
     else:
         reader.readfiles()
 
-    sorter = RomSorter(reader, compress_type=compress_type)
-    if outdir:
-        os.makedirs(outdir, exist_ok=True)
-        sorter.move_files(files, outdir)
-    elif action == 'organize':
-        sorter.organize_files(files)
-    elif action == 'rename':
-        sorter.rename_files(files)
+    # Exit through the finally block below, saving the cache, when killed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    journal = None
+    if outdir or action in ('organize', 'rename'):
+        try:
+            journal = MoveJournal()
+        except BlockingIOError:
+            print('ERROR: Another organize or rename run is in progress', file=sys.stderr)
+            return
+        if not resume and journal.count():
+            print('WARNING: Discarding the moves of an interrupted run (see --resume)',
+                  file=sys.stderr)
+            journal.clear()
+    hash_cache = HashCache() if use_cache else None
+    report = create_report(report_format)
+    sorter = RomSorter(
+        reader, compress_type=compress_type, hash_cache=hash_cache, report=report,
+        journal=journal, **sorter_options)
+    try:
+        if resume and journal is not None:
+            sorter.resume_moves()
+        if outdir:
+            os.makedirs(outdir, exist_ok=True)
+            sorter.move_files(files, outdir)
+        elif action == 'organize':
+            sorter.organize_files(files)
+        elif action == 'rename':
+            sorter.rename_files(files)
+        else:
+            sorter.check_files(files)
+        report.finish()
+        if journal is not None:
+            # Nothing is left to resume
+            journal.clear()
+    finally:
+        if hash_cache is not None:
+            hash_cache.close()
+        if journal is not None:
+            journal.close()
+
+def watch_directory(args):
+    """Runs the `watch` subcommand until interrupted."""
+
+    import signal
+    from romverify.hashcache import HashCache
+    from romverify.report import create_report
+    from romverify.watcher import WatchFolder
+
+    if not os.path.isdir(args.directory):
+        print('ERROR: Not a directory:', args.directory)
+        return
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    # Exit through the finally blocks below when stopped by a service manager
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    hash_cache = HashCache() if args.use_cache else None
+    report = create_report(args.format)
+    compress_type = None if args.compress == 'none' else args.compress
+    watch_folder = WatchFolder(
+        args.directory, report, output_dir=args.output_dir, settle=args.settle,
+        poll_interval=args.poll, compress_type=compress_type, compress_level=args.level,
+        jobs=args.jobs, use_processes=args.processes, hash_cache=hash_cache)
+    try:
+        watch_folder.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        report.finish()
+        if hash_cache is not None:
+            hash_cache.close()
+
+def dedupe_files(args):
+    """Runs the `dedupe` subcommand."""
+
+    from romverify.config import Config
+    from romverify.dedupe import find_duplicates, replace_with_link
+    from romverify.hashcache import HashCache
+    from romverify.scanner import FileScanner
+
+    paths = []
+    if args.collections:
+        config = Config()
+        if 'sorting' in config:
+            paths.extend(sorted(set(config['sorting'].values())))
+    paths.extend(args.paths)
+    if not paths:
+        print('ERROR: No paths given and no collection directories to search')
+        return
+    scanner = FileScanner(recursive=True, include=args.include, exclude=args.exclude)
+    hash_cache = HashCache() if args.use_cache else None
+    try:
+        duplicates = find_duplicates(scanner.scan(paths), hash_cache, args.jobs)
+    finally:
+        if hash_cache is not None:
+            hash_cache.close()
+
+    (extra_files, extra_bytes) = (0, 0)
+    for (kept, *copies) in duplicates:
+        print('Keeping:', kept)
+        for path in copies:
+            print('  Duplicate:', path)
+            try:
+                size = os.path.getsize(path)
+                if args.hardlink:
+                    replace_with_link(kept, path)
+                    print('    Replaced with a hard link')
+                elif args.remove:
+                    os.remove(path)
+                    print('    Removed')
+            except OSError as err:
+                print('    ERROR: %s' % err.strerror)
+                continue
+            extra_files += 1
+            extra_bytes += size
+    verb = 'Reclaimed' if args.hardlink or args.remove else 'Found'
+    print('%s %d duplicate files, %.1f MiB' % (verb, extra_files, extra_bytes / 2**20))
+
+def prune_cache(max_age_days, max_entries):
+    """Evicts old entries from the checksum cache."""
+
+    from romverify.hashcache import HashCache
+
+    hash_cache = HashCache()
+    removed = hash_cache.prune(max_age_days, max_entries)
+    hash_cache.close()
+    print('Removed %d cached checksums' % removed)
+
+def audit_collection(console, action, jobs=1, use_cache=True, move_to=None):
+    """Compares a console's collection directory against its DAT."""
+
+    import shutil
+    from romverify.collection import CollectionManifest, find_missing, find_strays
+    from romverify.config import Config
+    from romverify.datfiles import DatReader
+    from romverify.hashcache import HashCache
+    from romverify.romsorter import RomSorter, find_console
+
+    reader = DatReader()
+    reader.readfiles()
+    full_console = find_console(reader, console)
+    if full_console is None:
+        print('ERROR: Unknown console:', console)
+        return
+    config = Config()
+    collection_dir = config['sorting'].get(full_console) if 'sorting' in config else None
+    if collection_dir is None:
+        print('ERROR: No collection directory for console:', full_console)
+        print('       Use `collection-add` to set one')
+        return
+
+    hash_cache = HashCache() if use_cache else None
+    manifest = CollectionManifest()
+    try:
+        sorter = RomSorter(reader, hash_cache=hash_cache, jobs=jobs)
+        listing = manifest.refresh(collection_dir, sorter)
+    finally:
+        manifest.close()
+        if hash_cache is not None:
+            hash_cache.close()
+    console_roms = reader.get_console_roms(full_console)
+
+    if action == 'missing':
+        missing = find_missing(console_roms, listing)
+        partial = 0
+        for (game, found, total) in missing:
+            if found:
+                print('%s (partial: %d of %d ROMs)' % (game, found, total))
+                partial += 1
+            else:
+                print(game)
+        total_games = len({game for (_, game, _) in console_roms})
+        print('Missing %d of %d games for %s' % (
+            len(missing) - partial, total_games, full_console))
+        if partial:
+            print('%d more games are incomplete' % partial)
     else:
-        sorter.check_files(files)
+        strays = find_strays(console_roms, listing)
+        if move_to:
+            os.makedirs(move_to, exist_ok=True)
+        for relpath in strays:
+            print(relpath)
+            if move_to:
+                result = shutil.move(os.path.join(collection_dir, relpath), move_to)
+                print('  Moved to:', result)
+        print('Found %d stray files in %s' % (len(strays), collection_dir))
 
 def print_consoles():
     """Prints installed DAT consoles and their collection directories."""
 
+    from romverify.config import Config
+    from romverify.datindex import DatIndex, get_data_dir, get_index_file
+
     config = Config()
     config = config['sorting'] if 'sorting' in config else None
-    reader = DatReader()
-    reader.readfiles(header_only=True)
-    for console in sorted(reader.consoles):
+    # The index keeps a catalog of DAT headers, so no XML needs to be parsed here
+    data_dir = get_data_dir()
+    index = DatIndex(get_index_file(data_dir))
+    try:
+        headers = index.get_headers(data_dir)
+    finally:
+        index.close()
+    consoles = {console: version for (console, version) in headers.values()
+                if console is not None}
+    for console in sorted(consoles):
         print(console)
-        print('  Version:', reader.consoles[console])
+        print('  Version:', consoles[console])
         if config is not None:
             sort_to = config.get(console)
             if sort_to is not None:
@@ -170,31 +541,90 @@ def main():
     """Main entry point."""
 
     args = parse_args()
+    if args.profile or args.profile_output or args.cprofile or args.tracemalloc:
+        run_profiled(args)
+    else:
+        run_subcommand(args)
+
+def run_profiled(args):
+    """Runs a subcommand with stage timing and optionally cProfile and tracemalloc."""
+
+    import cProfile
+    import time
+    import tracemalloc
+
+    profiling.enable()
+    if args.tracemalloc:
+        tracemalloc.start()
+    profiler = cProfile.Profile() if args.cprofile else None
+    start_time = time.perf_counter()
+    try:
+        if profiler is not None:
+            profiler.runcall(run_subcommand, args)
+        else:
+            run_subcommand(args)
+    finally:
+        report = profiling.get_report(time.perf_counter() - start_time)
+        if profiler is not None:
+            profiler.dump_stats(args.cprofile)
+        if args.tracemalloc:
+            (_, peak) = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+            tracemalloc.stop()
+            report['tracemalloc'] = {
+                'peak_bytes': peak, 'top': [str(statistic) for statistic in top]}
+        if args.profile_output:
+            profiling.write_report(report, args.profile_output)
+        else:
+            profiling.print_report(report)
+            if args.tracemalloc:
+                print('Peak memory: %.1f MiB' % (peak / 2**20), file=sys.stderr)
+                for line in report['tracemalloc']['top']:
+                    print('  ' + line, file=sys.stderr)
+
+def run_subcommand(args):
+    """Runs the subcommand given on the command line."""
 
     if args.subcommand == 'organize':
-        compress_type = None if args.no_compress else 'zip'
-        verify_roms(args.files, 'organize', args.datfile, compress_type, args.output_dir)
+        compress_type = None if args.compress == 'none' else args.compress
+        verify_roms(
+            args.files, 'organize', args.datfile, compress_type, args.output_dir,
+            args.use_cache, resume=args.resume, compress_level=args.level,
+            **get_sorter_options(args))
     elif args.subcommand == 'rename':
-        compress_type = None if args.no_compress else 'zip'
-        verify_roms(args.files, 'rename', args.datfile, compress_type)
+        compress_type = None if args.compress == 'none' else args.compress
+        verify_roms(
+            args.files, 'rename', args.datfile, compress_type, use_cache=args.use_cache,
+            resume=args.resume, compress_level=args.level, **get_sorter_options(args))
     elif args.subcommand == 'check':
-        verify_roms(args.files, 'check', args.datfile)
+        verify_roms(
+            args.files, 'check', args.datfile, use_cache=args.use_cache, fast=args.fast,
+            strict=args.strict, **get_sorter_options(args))
     elif args.subcommand == 'collection-add':
+        from romverify.datfiles import DatReader
+        from romverify.romsorter import set_sorting_dir
         reader = DatReader()
         reader.readfiles(header_only=True)
         set_sorting_dir(reader, args.console, args.path)
     elif args.subcommand == 'collection-remove':
         raise NotImplementedError #TODO
     elif args.subcommand == 'collection-missing':
-        raise NotImplementedError #TODO
+        audit_collection(args.console, 'missing', args.jobs, args.use_cache)
+    elif args.subcommand == 'collection-strays':
+        audit_collection(args.console, 'strays', args.jobs, args.use_cache, args.move_to)
     elif args.subcommand == 'dat-add':
-        #TODO support importing a No-Intro daily zip that includes every console
-        for datfile in args.datfile:
-            install_dat_file(datfile, force=args.force)
+        from romverify.datfiles import install_dat_files
+        install_dat_files(args.datfile, force=args.force)
     elif args.subcommand == 'dat-remove':
         raise NotImplementedError #TODO
     elif args.subcommand == 'list':
         print_consoles()
+    elif args.subcommand == 'watch':
+        watch_directory(args)
+    elif args.subcommand == 'dedupe':
+        dedupe_files(args)
+    elif args.subcommand == 'cache-prune':
+        prune_cache(args.max_age, args.max_entries)
     else:
         raise RuntimeError('Unknown subcommand: %s' % args.subcommand)
 
@@ -0,0 +1,112 @@
+import json
+import sys
+import threading
+import time
+
+# Whether stages are being recorded. Check this before doing any extra work to profile.
+enabled = False
+
+# Totals by stage name: [calls, seconds, bytes]
+stages = {}
+lock = threading.Lock()
+
+class Stage:
+    """Context manager timing one call of a stage. Use add_bytes to count data processed."""
+    __slots__ = ('name', 'nbytes', 'start_time')
+
+    def __init__(self, name, nbytes):
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, time.perf_counter() - self.start_time, self.nbytes)
+
+    def add_bytes(self, nbytes):
+        self.nbytes += nbytes
+
+class NullStage:
+    """Stand-in for Stage when profiling is disabled, so timed code costs nothing extra."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def add_bytes(self, nbytes):
+        pass
+
+NULL_STAGE = NullStage()
+
+def stage(name, nbytes=0):
+    """Returns a context manager that adds the time spent within it to a stage."""
+    if not enabled:
+        return NULL_STAGE
+    return Stage(name, nbytes)
+
+def record(name, seconds, nbytes=0, calls=1):
+    with lock:
+        totals = stages.setdefault(name, [0, 0.0, 0])
+        totals[0] += calls
+        totals[1] += seconds
+        totals[2] += nbytes
+
+def enable():
+    global enabled
+    enabled = True
+
+def snapshot():
+    with lock:
+        return {name: list(totals) for (name, totals) in stages.items()}
+
+def merge(other_stages):
+    """Adds stages recorded elsewhere, like in a worker process."""
+    for (name, (calls, seconds, nbytes)) in other_stages.items():
+        record(name, seconds, nbytes, calls)
+
+def call_collecting(func, *args):
+    """Runs func in a worker process and returns (its result, the stages it recorded).
+
+    Worker processes have their own copy of this module, so their stages are sent back
+    with the result to be merged in the main process.
+    """
+    enable()
+    with lock:
+        stages.clear()
+    result = func(*args)
+    return (result, snapshot())
+
+def get_report(wall_seconds):
+    """Returns the recorded stages as a JSON-serializable dict, slowest first."""
+    report = {'wall_seconds': round(wall_seconds, 6), 'stages': {}}
+    for (name, (calls, seconds, nbytes)) in sorted(
+            snapshot().items(), key=lambda item: -item[1][1]):
+        report['stages'][name] = {
+            'calls': calls,
+            'seconds': round(seconds, 6),
+            'bytes': nbytes,
+            'mib_per_second': round(nbytes / seconds / 2**20, 1) if nbytes and seconds else None,
+        }
+    return report
+
+def print_report(report, out_fp=None):
+    out_fp = out_fp if out_fp is not None else sys.stderr
+    print('Profile (stage times are summed across worker threads and processes):', file=out_fp)
+    print('  %-16s %9s %11s %11s %9s' % ('stage', 'calls', 'seconds', 'MiB', 'MiB/s'),
+          file=out_fp)
+    for (name, info) in report['stages'].items():
+        print('  %-16s %9d %11.3f %11.1f %9s' % (
+            name, info['calls'], info['seconds'], info['bytes'] / 2**20,
+            '-' if info['mib_per_second'] is None else '%.1f' % info['mib_per_second']),
+            file=out_fp)
+    print('  %-16s %9s %11.3f' % ('wall time', '', report['wall_seconds']), file=out_fp)
+
+def write_report(report, filename):
+    with open(filename, 'w') as out_fp:
+        json.dump(report, out_fp, indent=2)
+        out_fp.write('\n')
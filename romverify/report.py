@@ -0,0 +1,160 @@
+import csv
+import json
+import sys
+import time
+
+REPORT_FORMATS = ('text', 'jsonl', 'csv')
+
+# Columns of each per-file record, in the order they are written as CSV
+RECORD_FIELDS = (
+    'path', 'archive', 'size', 'crc32', 'md5', 'sha1', 'sha256', 'console', 'rom_name', 'game',
+    'action', 'destination', 'message', 'hash_seconds', 'move_seconds')
+
+# Records are written in batches rather than one write per line
+BATCH_SIZE = 256
+
+def get_action(result):
+    """Summarizes what happened to a file as one of the keywords counted in reports."""
+    if result.destination is not None:
+        return 'moved'
+    if result.message is not None and not result.digests and not result.members:
+        return 'error' if result.message.startswith('ERROR') else 'skipped'
+    if result.rom_name is not None or result.game is not None:
+        return 'matched'
+    return 'unmatched'
+
+def get_records(result):
+    """Returns a flat record for a RomResult, followed by one for each file in an archive."""
+    record = {
+        'path': result.filename,
+        'archive': None,
+        'size': result.size,
+        'crc32': result.digests.get('crc32'),
+        'md5': result.digests.get('md5'),
+        'sha1': result.digests.get('sha1'),
+        'sha256': result.digests.get('sha256'),
+        'console': result.console,
+        'rom_name': result.rom_name,
+        'game': result.game,
+        'action': get_action(result),
+        'destination': result.destination,
+        'message': '; '.join(filter(None, [result.message] + result.notes)) or None,
+        'hash_seconds': round(result.hash_seconds, 6),
+        'move_seconds': round(result.move_seconds, 6),
+    }
+    records = [record]
+    for member in result.members:
+        (member_record,) = get_records(member)
+        member_record['archive'] = result.filename
+        records.append(member_record)
+    return records
+
+def create_report(report_format='text', out_fp=None):
+    if report_format == 'jsonl':
+        return JsonlReport(out_fp)
+    elif report_format == 'csv':
+        return CsvReport(out_fp)
+    return TextReport(out_fp)
+
+class TextReport:
+    """Human-readable report of verified files, printed as they are processed.
+
+    Subclasses write machine-readable records instead, overriding add_result, add_set and
+    write_summary. Every report counts results so a summary can be given at the end.
+    """
+    def __init__(self, out_fp=None):
+        self.out_fp = out_fp if out_fp is not None else sys.stdout
+        self.start_time = time.perf_counter()
+        self.counts = {}
+        self.total_files = 0
+        self.total_bytes = 0
+        self.pending = []
+
+    def add(self, result):
+        self.total_files += 1
+        if result.size is not None:
+            self.total_bytes += result.size
+        action = get_action(result)
+        self.counts[action] = self.counts.get(action, 0) + 1
+        self.add_result(result)
+
+    def add_result(self, result):
+        result.print(self.out_fp)
+
+    def add_set(self, console, game, total, missing):
+        """Reports whether every ROM was found for a game made of several files."""
+        print('Game:', game, file=self.out_fp)
+        print('  Console:', console, file=self.out_fp)
+        print('  Set:    ', '%s (%d of %d ROMs)' % (
+            'partial' if missing else 'complete', total - len(missing), total),
+            file=self.out_fp)
+        for rom_name in missing:
+            print('  Missing:', rom_name, file=self.out_fp)
+
+    def write(self, line):
+        self.pending.append(line)
+        if len(self.pending) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.out_fp.write(''.join(self.pending))
+        self.pending = []
+        self.out_fp.flush()
+
+    def get_summary(self):
+        elapsed = time.perf_counter() - self.start_time
+        return {
+            'files': self.total_files,
+            'bytes': self.total_bytes,
+            'seconds': round(elapsed, 3),
+            'files_per_second': round(self.total_files / elapsed, 1) if elapsed else None,
+            'mib_per_second': round(self.total_bytes / elapsed / 2**20, 1) if elapsed else None,
+            'counts': dict(sorted(self.counts.items())),
+        }
+
+    def finish(self):
+        """Writes the summary and anything still buffered."""
+        self.write_summary(self.get_summary())
+        self.flush()
+
+    def write_summary(self, summary):
+        counts = ', '.join('%d %s' % (count, action) for (action, count) in
+                           summary['counts'].items())
+        print('Summary: %d files (%s)' % (summary['files'], counts or 'none'), file=self.out_fp)
+        if summary['seconds']:
+            print('  %.1f MiB in %.2f s (%.1f files/s, %.1f MiB/s)' % (
+                summary['bytes'] / 2**20, summary['seconds'], summary['files_per_second'],
+                summary['mib_per_second']), file=self.out_fp)
+
+class JsonlReport(TextReport):
+    """One JSON object per line: a 'file' record per file, then 'set' and 'summary' records."""
+    def add_result(self, result):
+        for record in get_records(result):
+            self.write(json.dumps(dict(record='file', **record)) + '\n')
+
+    def add_set(self, console, game, total, missing):
+        self.write(json.dumps({
+            'record': 'set', 'console': console, 'game': game, 'total': total,
+            'found': total - len(missing), 'missing': missing}) + '\n')
+
+    def write_summary(self, summary):
+        self.write(json.dumps(dict(record='summary', **summary)) + '\n')
+
+class CsvReport(TextReport):
+    """CSV with a header row and one row per file.
+
+    Rows can't hold the set and summary records, so the summary goes to stderr instead.
+    """
+    def __init__(self, out_fp=None):
+        super().__init__(out_fp)
+        self.writer = csv.DictWriter(self, RECORD_FIELDS, lineterminator='\n')
+        self.writer.writeheader()
+
+    def add_result(self, result):
+        self.writer.writerows(get_records(result))
+
+    def add_set(self, console, game, total, missing):
+        pass
+
+    def write_summary(self, summary):
+        print('Summary:', json.dumps(summary), file=sys.stderr)
@@ -1,82 +1,540 @@
+import collections
+import concurrent.futures
+import lzma
+import multiprocessing
 import os
+import sys
+import time
+import zipfile
+import zlib
+from . import profiling
 from .config import Config
-from .filehandler import FileHandler
+from .datfiles import clean_file_name
+from .filehandler import DECODE_ERRORS, FileHandler, sync_path
+from .hashcache import get_cache_key
+from .report import TextReport
+from .scanner import FileScanner, get_signature, get_skip_reason
+
+# Moves whose destination directories are synced together, before their originals are deleted
+SYNC_BATCH = 64
+
+class RomResult:
+    """Outcome of verifying a single ROM file, or one file within an archive."""
+    def __init__(self, filename):
+        self.filename = filename
+        # Explains why the file couldn't be hashed, if it wasn't
+        self.message = None
+        # Hex digests by kind (see filehandler.DIGEST_KINDS)
+        self.digests = {}
+        self.console = None
+        self.rom_name = None
+        self.game = None
+        # For archives holding several files of a game: a RomResult for each of those files,
+        # and whether the archive has the 'complete' or only a 'partial' set of the game's ROMs
+        self.members = []
+        self.set_status = None
+        self.destination = None
+        self.notes = []
+        # Size of the file in bytes, and the time spent on it by each stage
+        self.size = None
+        self.hash_seconds = 0.0
+        self.move_seconds = 0.0
+        # Whether a file that looked compressed was hashed as is, because it couldn't be
+        # decompressed. A raw ROM can start with the same bytes as a gz or bz2 file.
+        self.is_raw = False
+
+    @property
+    def crc32(self):
+        return self.digests.get('crc32')
+
+    @property
+    def sha1sum(self):
+        return self.digests.get('sha1')
+
+    def print(self, file=None):
+        print('Processing:', self.filename, file=file)
+        self.print_details('  ', file)
+
+    def print_details(self, indent, file=None):
+        if self.message is not None:
+            print(indent + self.message, file=file)
+        if self.members:
+            for member in self.members:
+                print(indent + member.filename, file=file)
+                member.print_details(indent + '  ', file)
+            if self.game is None:
+                print(indent + 'No matching game found', file=file)
+                return
+            print(indent + 'Console: ', self.console, file=file)
+            print(indent + 'Game:    ', self.game, file=file)
+            print(indent + 'Set:     ', self.set_status, file=file)
+        else:
+            if self.sha1sum is None and self.crc32 is None:
+                return
+            if self.crc32 is not None:
+                print(indent + 'crc32:   ', self.crc32, file=file)
+            if self.sha1sum is not None:
+                print(indent + 'sha1sum: ', self.sha1sum, file=file)
+            if self.rom_name is None:
+                print(indent + 'No match found', file=file)
+                return
+            print(indent + 'Console: ', self.console, file=file)
+            print(indent + 'ROM name:', self.rom_name, file=file)
+        for note in self.notes:
+            print(indent + note, file=file)
+        if self.destination is not None:
+            print(indent + 'Moved to:', self.destination, file=file)
+
+def move_rom(filename, dest_path, compress_type, level=None, is_raw=False):
+    """Moves a ROM file. Returns (destination, notes, seconds taken, obsolete files).
+
+    With is_raw, the file is treated as uncompressed whatever its first bytes look like.
+    Originals that were copied rather than renamed are left in place, for the caller to delete
+    once the destination directory is synced. This may run in a worker thread.
+    """
+    start_time = time.perf_counter()
+    romfile = FileHandler(filename)
+    if is_raw:
+        romfile.stream_type = None
+    destination = romfile.move(dest_path, compress_type, level, keep_source=True)
+    return (destination, romfile.notes, time.perf_counter() - start_time,
+            romfile.obsolete_files)
+
+def run_now(function, *args):
+    """Calls a function right away, returning a finished Future of its result or error."""
+    future = concurrent.futures.Future()
+    try:
+        future.set_result(function(*args))
+    except Exception as err:
+        future.set_exception(err)
+    return future
+
+def hash_rom(filename, kinds=('sha1',)):
+    """Hashes a single ROM file, decompressing it if needed.
+
+    This may run in a worker thread or process.
+    """
+    start_time = time.perf_counter()
+    result = hash_rom_file(filename, kinds)
+    result.hash_seconds = time.perf_counter() - start_time
+    return result
+
+def hash_rom_file(filename, kinds):
+    result = RomResult(filename)
+    romfile = FileHandler(filename)
+    if romfile.stream_type is not None:
+        try:
+            result.digests = romfile.get_digests(kinds)
+            return result
+        except DECODE_ERRORS as err:
+            # Truncated or corrupt data, or a 7z archive that can't be read. It might also be
+            # an uncompressed ROM that happens to start like one, so it's matched as is too.
+            result.message = 'ERROR: Unable to decompress file: %s' % err
+            romfile.stream_type = None
+            result.is_raw = True
+    try:
+        if not romfile.is_zipfile:
+            result.digests = romfile.get_digests(kinds)
+            return result
+        members = romfile.get_member_digests(kinds)
+    except OSError as err:
+        result.message = 'ERROR: Unable to read file: %s' % err
+        return result
+    except (zipfile.BadZipFile, EOFError, lzma.LZMAError, zlib.error, NotImplementedError,
+            RuntimeError) as err:
+        # Corrupt data, or a compression method or encryption that zipfile doesn't support
+        result.message = 'ERROR: Unable to read archive: %s' % err
+        return result
+    if not members:
+        result.message = 'ERROR: Archive is empty'
+    elif len(members) == 1:
+        result.digests = members[0][1]
+    else:
+        for (member_name, digests) in members:
+            member = RomResult(member_name)
+            member.digests = digests
+            result.members.append(member)
+    return result
+
+def get_process_context():
+    """Returns the multiprocessing context for worker processes started by a running sorter."""
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+def get_archive_result(filename, infolist, member_digests):
+    """Returns a RomResult for a file from the digests of each file in it, in `infolist` order.
+
+    A single file is described by the result itself, several by its members.
+    """
+    result = RomResult(filename)
+    if len(infolist) == 1:
+        result.digests = member_digests[0]
+        return result
+    for (member_info, digests) in zip(infolist, member_digests):
+        member = RomResult(member_info.filename)
+        member.digests = digests
+        result.members.append(member)
+    return result
 
 class RomSorter:
     def __init__(self,
                  datreader,
-                 compress_type=None):
+                 compress_type=None,
+                 compress_level=None,
+                 jobs=1,
+                 use_processes=False,
+                 hash_cache=None,
+                 fast=False,
+                 strict=False,
+                 scanner=None,
+                 report=None,
+                 journal=None):
         self.datreader = datreader
         self.compress_type = compress_type
+        self.compress_level = compress_level
+        self.jobs = jobs
+        self.use_processes = use_processes
+        self.hash_cache = hash_cache
+        self.fast = fast
+        self.strict = strict
+        self.scanner = scanner if scanner is not None else FileScanner()
+        self.report = report if report is not None else TextReport()
+        # A MoveJournal, to record moves so that an interrupted run can be resumed
+        self.journal = journal
         self.sort_config = None
+        self.digest_kinds = ('sha1',)
+        # ROM names found for each (console, game), to check multi-file games for completeness
+        self.found_roms = {}
+        # Finished moves whose destinations aren't synced yet: [(source, destination,
+        # obsolete files)]
+        self.unsynced = []
 
     def read_sort_config(self):
         parser = Config()
         self.sort_config = parser['sorting'] if 'sorting' in parser else {}
 
     def move_files(self, filenames, output_dir):
-        for filename in filenames:
-            (_, rom_name) = self.process_file(filename)
-            if rom_name is None:
-                continue
-            romfile = FileHandler(filename)
-            result = romfile.move(os.path.join(output_dir, rom_name), self.compress_type)
-            print('  Moved to:', result)
+        return self.sort_files(filenames, lambda result: output_dir)
 
     def organize_files(self, filenames, using_config=True):
-        for filename in filenames:
-            (console, rom_name) = self.process_file(filename)
-            if rom_name is None:
-                continue
-            dest_dir = os.path.dirname(os.path.realpath(filename))
+        def get_dest_dir(result):
+            dest_dir = os.path.dirname(os.path.realpath(result.filename))
             if using_config:
                 if self.sort_config is None:
                     self.read_sort_config()
-                dest_dir = self.sort_config.get(console, dest_dir)
-            romfile = FileHandler(filename)
-            result = romfile.move(os.path.join(dest_dir, rom_name), self.compress_type)
-            print('  Moved to:', result)
+                dest_dir = self.sort_config.get(result.console, dest_dir)
+            return dest_dir
+        return self.sort_files(filenames, get_dest_dir)
+
+    def sort_files(self, filenames, get_dest_dir):
+        """Moves each matched file into the directory given by get_dest_dir(result).
+
+        Compression runs in a worker pool while the following files are hashed, but results
+        are still reported in order. Returns the list of destinations of the moved files.
+        """
+        executor = None
+        if self.jobs > 1:
+            # zlib, lzma and bz2 all release the GIL while compressing
+            executor = concurrent.futures.ThreadPoolExecutor(self.jobs)
+        pending = collections.deque()
+        # Moves in progress by destination, so two files never get written to the same place
+        moving = {}
+        destinations = []
+        try:
+            for result in self.process_files(filenames):
+                move = None
+                dest_name = result.rom_name
+                if result.members and result.game is not None:
+                    # Archives of multi-file games are named after the game instead of a ROM
+                    dest_name = clean_file_name(result.game) + '.zip'
+                if dest_name is not None:
+                    dest_path = os.path.join(get_dest_dir(result), dest_name)
+                    if self.journal is not None:
+                        self.journal.plan(
+                            result, dest_path, self.compress_type, self.compress_level)
+                    if executor is None:
+                        move = run_now(
+                            move_rom, result.filename, dest_path, self.compress_type,
+                            self.compress_level, result.is_raw)
+                    else:
+                        if dest_path in moving:
+                            concurrent.futures.wait([moving[dest_path]])
+                        move = executor.submit(
+                            move_rom, result.filename, dest_path, self.compress_type,
+                            self.compress_level, result.is_raw)
+                        moving[dest_path] = move
+                pending.append((result, move))
+                while pending and (executor is None or pending[0][1] is None or
+                                   pending[0][1].done() or len(pending) >= self.jobs * 4):
+                    destinations.append(self.finish_move(*pending.popleft()))
+            while pending:
+                destinations.append(self.finish_move(*pending.popleft()))
+            self.sync_moves()
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        self.print_set_summary()
+        return [destination for destination in destinations if destination is not None]
+
+    def finish_move(self, result, move):
+        if move is not None:
+            try:
+                move = move.result()
+            except OSError as err:
+                # Like a full disk or a destination that's a directory. The file stays where it
+                # is, and its journal entry is left for a later run to retry.
+                result.message = 'ERROR: Unable to move file: %s' % err
+                move = None
+        if move is not None:
+            (result.destination, notes, result.move_seconds, obsolete_files) = move
+            result.notes.extend(notes)
+            self.unsynced.append((result.filename, result.destination, obsolete_files))
+            if len(self.unsynced) >= SYNC_BATCH:
+                self.sync_moves()
+        self.report.add(result)
+        return result.destination
+
+    def sync_moves(self):
+        """Makes the finished moves durable, then deletes the originals they replaced.
+
+        Each destination directory is synced once per batch of moves rather than once per
+        file. Until then, a crash leaves the originals in place to be moved again.
+        """
+        if not self.unsynced:
+            return
+        with profiling.stage('fsync'):
+            for directory in {os.path.dirname(os.path.abspath(destination))
+                              for (_, destination, _) in self.unsynced}:
+                sync_path(directory)
+        if self.journal is not None:
+            self.journal.complete(
+                [(source, destination) for (source, destination, _) in self.unsynced])
+        for (_, _, obsolete_files) in self.unsynced:
+            for filename in obsolete_files:
+                try:
+                    os.remove(filename)
+                except OSError as err:
+                    print('WARNING: Unable to delete the original of a moved file:', err,
+                          file=sys.stderr)
+        self.unsynced = []
+
+    def resume_moves(self):
+        """Finishes the moves recorded in the journal by an interrupted run.
+
+        Files are moved as they were matched then, without hashing them again. Any file that
+        changed since is left to be processed like the others.
+        """
+        for (source, signature, dest_path, compress_type, compress_level, result,
+             destination) in self.journal.get_moves():
+            current = get_signature(source)
+            if destination is not None:
+                # Completed, but the original may not have been deleted yet
+                if current == signature and os.path.abspath(destination) != source:
+                    os.remove(source)
+                continue
+            if current is None:
+                # Renamed before the interruption
+                continue
+            if current != signature:
+                self.journal.handled.discard(source)
+                continue
+            result.notes.append('Resuming an interrupted move')
+            self.add_found(result)
+            self.finish_move(result, run_now(
+                move_rom, source, dest_path, compress_type, compress_level, result.is_raw))
+        self.sync_moves()
 
     def rename_files(self, filenames):
         self.organize_files(filenames, using_config=False)
 
     def check_files(self, filenames):
-        for filename in filenames:
-            self.process_file(filename)
+        for result in self.process_files(filenames):
+            self.report.add(result)
+        self.print_set_summary()
 
     def process_file(self, filename):
-        print('Processing:', filename)
-        sha1sum = None
-        if not os.path.exists(filename):
-            print('  ERROR: File does not exist')
-        elif os.path.isdir(filename):
-            print('  Skipping directory')
-        elif os.path.islink(filename):
-            print('  Skipping symbolic link')
-        elif not os.path.isfile(filename):
-            print('  Skipping special file')
-        else:
-            try:
-                romfile = FileHandler(filename)
-                sha1sum = romfile.get_sha1sum()
-                print('  sha1sum: ', sha1sum)
-            except ValueError:
-                print('  ERROR: Archives must have exactly one file')
-        if sha1sum is None:
+        (result,) = self.hash_files([filename])
+        self.match(result)
+        self.report.add(result)
+        return (result.console, result.rom_name)
+
+    def process_files(self, filenames):
+        """Yields a matched RomResult for each file, in the same order as `filenames`.
+
+        Directories are expanded into the files within them if the scanner is recursive.
+        Lookups and anything done with the results stay in the calling thread.
+        """
+        for result in self.hash_files(filenames):
+            with profiling.stage('match'):
+                self.match(result)
+            yield result
+
+    def hash_files(self, filenames):
+        # SHA-1 is always computed, plus whatever else the DATs can be matched against
+        extra_kinds = self.datreader.get_digest_kinds() - {'sha1'}
+        self.digest_kinds = ('sha1',) + tuple(sorted(extra_kinds))
+        # zlib, lzma and bz2 release the GIL only within each call, while the gzip, zipfile
+        # and py7zr readers around them run Python code for every chunk, so compressed files
+        # are hashed in worker processes. hashlib releases the GIL while hashing large chunks,
+        # so threads scale for uncompressed files.
+        executors = {}
+        pending = collections.deque()
+        try:
+            for (filename, stat_result) in self.scanner.scan(filenames):
+                if self.journal is not None and self.journal.is_handled(filename):
+                    # Already moved by resume_moves
+                    continue
+                (cache_keys, result) = self.prepare(filename, stat_result)
+                if result is None:
+                    if self.jobs > 1:
+                        executor = self.get_executor(executors, filename)
+                        if profiling.enabled and \
+                                isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+                            result = executor.submit(
+                                profiling.call_collecting, hash_rom, filename, self.digest_kinds)
+                        else:
+                            result = executor.submit(hash_rom, filename, self.digest_kinds)
+                    else:
+                        result = hash_rom(filename, self.digest_kinds)
+                pending.append((cache_keys, result, stat_result))
+                # Don't queue up the entire input when given a huge list of files
+                while pending and (self.jobs <= 1 or len(pending) >= self.jobs * 4):
+                    yield self.finish_hash(*pending.popleft())
+            while pending:
+                yield self.finish_hash(*pending.popleft())
+        finally:
+            for executor in executors.values():
+                executor.shutdown(cancel_futures=True)
+
+    def get_executor(self, executors, filename):
+        """Returns the worker pool suited to hashing a file, creating it on first use."""
+        use_processes = self.use_processes or FileHandler(filename).is_compressed
+        if use_processes not in executors:
+            if use_processes:
+                # This can be mid-run with move threads active, and forking a process with
+                # other threads could leave the child with locks that are never released
+                executors[use_processes] = concurrent.futures.ProcessPoolExecutor(
+                    self.jobs, mp_context=get_process_context())
+            else:
+                executors[use_processes] = concurrent.futures.ThreadPoolExecutor(self.jobs)
+        return executors[use_processes]
+
+    def prepare(self, filename, stat_result):
+        """Resolves a file from its metadata alone when possible, before it would be hashed.
+
+        Zip archives are looked up by the CRC32 and size of each file in them, so archives of
+        several files can be resolved as well. Returns (cache keys, one for each file in the
+        archive or just one, or None; RomResult or None if the file still needs to be hashed).
+        """
+        message = get_skip_reason(filename, stat_result)
+        if message is not None:
+            result = RomResult(filename)
+            result.message = message
+            return (None, result)
+        if self.hash_cache is None and not self.fast:
             return (None, None)
-        rom_desc = self.datreader.get_rominfo(sha1sum=sha1sum)
-        if rom_desc is None:
-            print('  No match found')
+        try:
+            romfile = FileHandler(filename)
+            infolist = romfile.get_member_infolist() if romfile.is_zipfile else [None]
+        except (OSError, ValueError, zipfile.BadZipFile):
+            # Let hash_rom report the problem
             return (None, None)
-        print('  Console: ', rom_desc[0])
-        print('  ROM name:', rom_desc[1])
-        return rom_desc
+        if not infolist:
+            return (None, None)
+        cache_keys = None
+        if self.hash_cache is not None:
+            cache_keys = [get_cache_key(stat_result, member_info) for member_info in infolist]
+            with profiling.stage('cache'):
+                cached = [self.hash_cache.get(key, self.digest_kinds) for key in cache_keys]
+            if None not in cached:
+                result = get_archive_result(filename, infolist, cached)
+                return (None, result)
+        if self.fast and infolist[0] is not None:
+            # The zip central directory has the CRC32 and size without decompressing anything
+            candidates = [self.datreader.get_rominfo_by_crc(member_info.file_size, member_info.CRC)
+                          for member_info in infolist]
+            if not self.strict or candidates.count(None) == len(candidates):
+                result = get_archive_result(
+                    filename, infolist,
+                    [{'crc32': '%08X' % member_info.CRC} for member_info in infolist])
+                for (rom_result, candidate) in zip(result.members or [result], candidates):
+                    if candidate is not None:
+                        (rom_result.console, rom_result.rom_name, rom_result.game) = candidate
+                return (None, result)
+        return (cache_keys, None)
 
-def set_sorting_dir(datreader, console, path):
-    config = Config()
-    if 'sorting' not in config:
-        config['sorting'] = {}
-    is_modified = False
+    def finish_hash(self, cache_keys, result, stat_result):
+        if isinstance(result, concurrent.futures.Future):
+            result = result.result()
+            if isinstance(result, tuple):
+                # Stages recorded by a worker process, see profiling.call_collecting
+                (result, stages) = result
+                profiling.merge(stages)
+        if stat_result is not None:
+            # The file may be gone by now, so its size is taken from when it was scanned
+            result.size = stat_result.st_size
+        # Digests of a file that couldn't be decompressed aren't cached, as the cache can't
+        # tell that they're of the raw data
+        if cache_keys is not None and not result.is_raw:
+            with profiling.stage('cache'):
+                if len(cache_keys) == 1 and result.digests:
+                    self.hash_cache.put(cache_keys[0], result.digests)
+                elif len(cache_keys) == len(result.members):
+                    for (key, member) in zip(cache_keys, result.members):
+                        self.hash_cache.put(key, member.digests)
+        return result
+
+    def match(self, result):
+        if result.members:
+            for member in result.members:
+                self.match(member)
+            games = {(member.console, member.game) for member in result.members
+                     if member.game is not None}
+            # An archive can only be sorted as a set when all of its matches agree on the game
+            if len(games) != 1:
+                return
+            (result.console, result.game) = games.pop()
+            expected = self.datreader.get_game_roms(result.console, result.game)
+            found = {member.rom_name for member in result.members}
+            result.set_status = '%s (%d of %d ROMs)' % (
+                'complete' if found >= expected.keys() else 'partial',
+                len(expected.keys() & found), len(expected))
+            return
+        if result.sha1sum is not None:
+            rom_descs = self.datreader.get_all_rominfo(digests=result.digests)
+            if rom_descs:
+                (result.console, result.rom_name, result.game) = rom_descs[0]
+                if result.is_raw:
+                    # Not compressed after all, so failing to decompress it was no error
+                    result.message = None
+                # The same ROM listed by another console's DAT is a conflict worth knowing
+                for (console, rom_name, _) in rom_descs[1:]:
+                    if console != result.console:
+                        result.notes.append('Also in %s as: %s' % (console, rom_name))
+        self.add_found(result)
+
+    def add_found(self, result):
+        if result.members:
+            for member in result.members:
+                self.add_found(member)
+        elif result.game is not None:
+            self.found_roms.setdefault((result.console, result.game), set()).add(result.rom_name)
+
+    def print_set_summary(self):
+        """Reports whether every ROM was found for each game made of several files."""
+        for (console, game) in sorted(self.found_roms):
+            expected = self.datreader.get_game_roms(console, game)
+            if len(expected) <= 1:
+                continue
+            found = self.found_roms[(console, game)]
+            missing = sorted(expected.keys() - found)
+            self.report.add_set(console, game, len(expected), missing)
+
+def find_console(datreader, console):
+    """Resolves a console name as given by the user, or returns None if it's unknown."""
+    if console in datreader.consoles:
+        return console
     # Allow shortened names without vendor, like "Nintendo DS" for "Nintendo - Nintendo DS"
     shortened_consoles = {}
     for full_console in datreader.consoles:
@@ -88,12 +546,19 @@ def set_sorting_dir(datreader, console, path):
                 shortened_consoles[shortname] = None
                 continue
             shortened_consoles[shortname] = full_console
-    if console not in datreader.consoles:
-        console = shortened_consoles.get(console)
-    if console is None:
-        print('ERROR: Unknown console:', splits[0])
+    return shortened_consoles.get(console)
+
+def set_sorting_dir(datreader, console, path):
+    config = Config()
+    if 'sorting' not in config:
+        config['sorting'] = {}
+    is_modified = False
+    full_console = find_console(datreader, console)
+    if full_console is None:
+        print('ERROR: Unknown console:', console)
         print('       Please install a DAT file before setting a sorting directory')
         return
+    console = full_console
     print('Console:', console)
     new_path = os.path.realpath(path)
     old_path = config['sorting'].get(console)
@@ -0,0 +1,95 @@
+import fnmatch
+import os
+import stat
+import sys
+from . import profiling
+
+def get_skip_reason(path, stat_result):
+    """Returns why a path can't be hashed as a ROM, or None if it's a regular file.
+
+    `stat_result` is from lstat, or None if the path doesn't exist.
+    """
+    if stat_result is None:
+        return 'ERROR: File does not exist'
+    if stat.S_ISLNK(stat_result.st_mode):
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            return 'ERROR: File does not exist'
+        if stat.S_ISDIR(stat_result.st_mode):
+            return 'Skipping directory'
+        return 'Skipping symbolic link'
+    if stat.S_ISDIR(stat_result.st_mode):
+        return 'Skipping directory'
+    if not stat.S_ISREG(stat_result.st_mode):
+        return 'Skipping special file'
+    return None
+
+def get_signature(path):
+    """Returns what identifies a version of a file, or None if it isn't a regular file."""
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(stat_result.st_mode):
+        return None
+    return (stat_result.st_size, stat_result.st_mtime_ns)
+
+class FileScanner:
+    """Expands the paths given on the command line into a stream of files to verify.
+
+    Directories are only walked when recursive. Their files are yielded as they're found,
+    reusing the stat information from os.scandir instead of checking each file again.
+    """
+    def __init__(self, recursive=False, include=None, exclude=None, max_depth=None):
+        self.recursive = recursive
+        # Globs matched against file names. Excludes also apply to directory names.
+        self.include = include or []
+        self.exclude = exclude or []
+        self.max_depth = max_depth
+
+    def scan(self, paths):
+        """Yields (path, lstat result or None if missing) for each path and discovered file."""
+        for path in paths:
+            try:
+                with profiling.stage('scan'):
+                    stat_result = os.lstat(path)
+            except OSError:
+                yield (path, None)
+                continue
+            if self.recursive and stat.S_ISDIR(stat_result.st_mode):
+                yield from self.scan_dir(path, 0)
+            else:
+                yield (path, stat_result)
+
+    def scan_dir(self, path, depth):
+        try:
+            with profiling.stage('scan'), os.scandir(path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as err:
+            print('WARNING: Unable to read directory:', path, '(%s)' % err.strerror,
+                  file=sys.stderr)
+            return
+        subdirs = []
+        for entry in entries:
+            if self.matches(entry.name, self.exclude):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if self.max_depth is None or depth < self.max_depth:
+                    subdirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                if self.include and not self.matches(entry.name, self.include):
+                    continue
+                try:
+                    with profiling.stage('scan'):
+                        stat_result = entry.stat(follow_symlinks=False)
+                except OSError:
+                    # Removed since the directory was listed
+                    continue
+                yield (entry.path, stat_result)
+        for subdir in subdirs:
+            yield from self.scan_dir(subdir, depth + 1)
+
+    @staticmethod
+    def matches(name, patterns):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
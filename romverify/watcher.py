@@ -0,0 +1,215 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from .datfiles import DatReader, get_data_dir
+from .romsorter import RomSorter
+from .scanner import get_signature
+
+# inotify event masks from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+STRUCT_INOTIFY_EVENT = 'iIII'
+
+# Most files handed to the sorter at once, so new arrivals aren't stuck behind a huge batch
+MAX_BATCH = 256
+
+class InotifyWatcher:
+    """Waits for changes to files in a set of directories using Linux inotify."""
+    def __init__(self, directories):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {}
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(errno, 'inotify_add_watch failed', directory)
+            self.directories[wd] = directory
+
+    def close(self):
+        os.close(self.fd)
+
+    def wait(self, timeout):
+        """Waits up to `timeout` seconds, or indefinitely for None, for changes.
+
+        Returns the set of changed paths, or None if events were lost and every directory
+        needs to be scanned again.
+        """
+        (readable, _, _) = select.select([self.fd], [], [], timeout)
+        changed = set()
+        if not readable:
+            return changed
+        header_size = struct.calcsize(STRUCT_INOTIFY_EVENT)
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                (wd, mask, _, name_length) = struct.unpack_from(
+                    STRUCT_INOTIFY_EVENT, data, offset)
+                name = data[offset + header_size:offset + header_size + name_length]
+                offset += header_size + name_length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                if wd in self.directories and name:
+                    name = os.fsdecode(name.rstrip(b'\0'))
+                    changed.add(os.path.join(self.directories[wd], name))
+
+class PollingWatcher:
+    """Fallback for systems without inotify that has every directory scanned periodically."""
+    def __init__(self, interval):
+        self.interval = interval
+
+    def close(self):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        return None
+
+class WatchFolder:
+    """Sorts ROM files as they are dropped into a directory.
+
+    A file is only picked up once it has stopped changing for `settle` seconds, so files
+    still being copied or downloaded aren't hashed halfway. Installed DATs are re-indexed
+    whenever the DAT directory changes, without restarting.
+    """
+    def __init__(self, directory, report, output_dir=None, settle=2.0, poll_interval=None,
+                 **sorter_options):
+        self.directory = os.path.abspath(directory)
+        self.report = report
+        self.output_dir = output_dir
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.sorter_options = sorter_options
+        self.data_dir = get_data_dir()
+        self.datreader = None
+        self.dat_listing = None
+        # When the DAT directory last changed, if it hasn't been reloaded since
+        self.dats_changed = None
+        # Files waiting to settle: {path: (signature, monotonic time it was last seen changing)}
+        self.candidates = {}
+        # Signatures of files that were processed and left here, so they aren't retried
+        self.finished = {}
+
+    def run(self):
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.load_dats()
+        watcher = self.create_watcher()
+        try:
+            self.scan()
+            while True:
+                waiting = self.candidates or self.dats_changed is not None
+                changed = watcher.wait(self.settle / 2 if waiting else None)
+                if changed is None:
+                    if self.get_dat_listing() != self.dat_listing:
+                        self.dats_changed = time.monotonic()
+                    self.scan()
+                else:
+                    for path in changed:
+                        if os.path.dirname(path) == self.data_dir:
+                            self.dats_changed = time.monotonic()
+                        elif os.path.dirname(path) == self.directory:
+                            self.add_candidate(path)
+                # Like ROMs, DATs are only loaded once they've stopped changing
+                if self.dats_changed is not None and \
+                        time.monotonic() - self.dats_changed >= self.settle:
+                    self.load_dats()
+                    self.scan()
+                self.process_ready()
+        finally:
+            watcher.close()
+
+    def create_watcher(self):
+        if self.poll_interval is None:
+            try:
+                return InotifyWatcher([self.directory, self.data_dir])
+            except (OSError, AttributeError) as err:
+                # AttributeError: the C library has no inotify functions
+                print('WARNING: inotify is unavailable, polling instead (%s)' % err,
+                      file=sys.stderr)
+        return PollingWatcher(self.poll_interval or 5.0)
+
+    def load_dats(self):
+        print('Loading DAT files from', self.data_dir, file=sys.stderr)
+        datreader = DatReader()
+        datreader.readfiles(self.data_dir)
+        if self.datreader is not None:
+            self.datreader.index.close()
+        self.datreader = datreader
+        self.dat_listing = self.get_dat_listing()
+        self.dats_changed = None
+        # Files that didn't match before might match the new DATs
+        self.finished.clear()
+
+    def get_dat_listing(self):
+        listing = {}
+        for entry in os.scandir(self.data_dir):
+            stat_result = entry.stat()
+            listing[entry.name] = (stat_result.st_size, stat_result.st_mtime_ns)
+        return listing
+
+    def scan(self):
+        for entry in os.scandir(self.directory):
+            self.add_candidate(entry.path)
+
+    def add_candidate(self, path):
+        # Hidden files are usually temporary files of downloads or rsync
+        if os.path.basename(path).startswith('.'):
+            return
+        signature = get_signature(path)
+        if signature is None:
+            self.candidates.pop(path, None)
+        elif self.finished.get(path) != signature:
+            previous = self.candidates.get(path)
+            if previous is None or previous[0] != signature:
+                self.candidates[path] = (signature, time.monotonic())
+
+    def process_ready(self):
+        now = time.monotonic()
+        ready = []
+        for (path, (signature, since)) in list(self.candidates.items()):
+            current = get_signature(path)
+            if current is None:
+                del self.candidates[path]
+            elif current != signature:
+                # Still growing
+                self.candidates[path] = (current, now)
+            elif now - since >= self.settle:
+                del self.candidates[path]
+                ready.append(path)
+        ready.sort()
+        for start in range(0, len(ready), MAX_BATCH):
+            self.sort_batch(ready[start:start + MAX_BATCH])
+
+    def sort_batch(self, filenames):
+        # A new sorter per batch picks up any change to the collection directories
+        sorter = RomSorter(self.datreader, report=self.report, **self.sorter_options)
+        if self.output_dir:
+            destinations = sorter.move_files(filenames, self.output_dir)
+        else:
+            destinations = sorter.organize_files(filenames)
+        self.report.flush()
+        # Remember what's left in this directory, like unmatched files or renamed ones
+        for path in filenames + destinations:
+            if os.path.dirname(path) == self.directory:
+                signature = get_signature(path)
+                if signature is not None:
+                    self.finished[path] = signature
+                    self.candidates.pop(path, None)
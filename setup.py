@@ -12,5 +12,10 @@ setup(
             'romverify = romverify.main:main'
         ]
     },
-    packages=find_packages()
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
+    extras_require={
+        # Reading 7z files uses the extraction API of py7zr 1.0
+        '7z': ['py7zr>=1.0'],
+        'zstd': ['zstandard'],
+    }
 )